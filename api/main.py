@@ -322,7 +322,9 @@ def presign_download(
 def create_edit_job(payload: Dict[str, Any], user: AuthUser = Depends(get_current_user)):
     """
     建立自動剪輯任務。
-    payload = { "key": <來源 S3 key>, "options": { "superResolution": bool, "fps60": bool } }
+    payload = { "key": <來源 S3 key>, "options": { "superResolution": bool, "fps60": bool, "cameraProfile": str,
+                                                  "overlay": bool } }
+    overlay=true：不產生燒框的 detect_annotated.mp4，只發布 overlay.json（GET /edits/{id}/overlay）
     """
     src_key = payload.get("key") or ""
     ensure_own_key(user, src_key)
@@ -341,6 +343,8 @@ def create_edit_job(payload: Dict[str, Any], user: AuthUser = Depends(get_curren
             "options": {
                 "superResolution": bool(options.get("superResolution", False)),
                 "fps60": bool(options.get("fps60", False)),
+                "cameraProfile": str(options.get("cameraProfile") or "")[:64],
+                "overlay": bool(options.get("overlay", False)),
             },
         },
         job_timeout="7h",
@@ -360,7 +364,7 @@ def get_edit_job(job_id: str, user: AuthUser = Depends(get_current_user)):
     status = job.get_status()
     meta = job.meta or {}
 
-    for k in ("outputKey", "jsonKey", "detectMp4Key"):
+    for k in ("outputKey", "jsonKey", "npzKey", "overlayKey", "detectMp4Key"):
         v = meta.get(k)
         if v is not None:
             ensure_own_key(user, v)
@@ -370,6 +374,8 @@ def get_edit_job(job_id: str, user: AuthUser = Depends(get_current_user)):
         "status": status,
         "outputKey": meta.get("outputKey"),
         "jsonKey": meta.get("jsonKey"),
+        "npzKey": meta.get("npzKey"),
+        "overlayKey": meta.get("overlayKey"),
         "detectMp4Key": meta.get("detectMp4Key"),
         "error": meta.get("error"),
         "logs": (meta.get("logs") or [])[:50],  # 最多 50 行簡單日志
@@ -377,6 +383,28 @@ def get_edit_job(job_id: str, user: AuthUser = Depends(get_current_user)):
     }
     return resp
 
+@app.get("/edits/{job_id}/overlay")
+def get_edit_overlay(job_id: str, expires: int = 600, user: AuthUser = Depends(get_current_user)):
+    """疊圖軌 overlay.json 的簽名網址：{fps, width, height, names, frames: [[t_ms, [[cls,x1,y1,x2,y2,conf%,flags],...]],...]}，
+    播放器依 video.currentTime 找最近的 t_ms 自己畫框"""
+    try:
+        job = Job.fetch(job_id, connection=redis_conn)
+    except Exception:
+        raise HTTPException(status_code=404, detail="job not found")
+
+    key = (job.meta or {}).get("overlayKey")
+    if not key:
+        raise HTTPException(status_code=404, detail="overlay not available")
+    ensure_own_key(user, key)
+
+    url = s3_internal.generate_presigned_url(
+        ClientMethod="get_object",
+        Params={"Bucket": bucket_for_key(key), "Key": key},
+        ExpiresIn=max(60, min(expires, 7 * 24 * 3600)),
+    )
+    p = urlparse(url)
+    return {"key": key, "url": "/s3" + p.path + ("?" + p.query if p.query else "")}
+
 @app.post("/edits/{job_id}/cancel")
 def cancel_edit_job(job_id: str, user: AuthUser = Depends(get_current_user)):
     """
@@ -419,10 +447,12 @@ def cancel_edit_job(job_id: str, user: AuthUser = Depends(get_current_user)):
     job.save_meta()
 
     # 若你的 RQ 版本支援 soft stop，可嘗試通知（不一定能立即殺掉子進程）
-    try:
-        send_stop_job_command(redis_conn, job_id)
-    except Exception:
-        pass
+    # 跑在 SimpleWorker 裡的 job（meta.inprocess）沒有 work-horse，stop 指令會把整個 worker 殺掉：只靠上面的旗標
+    if not meta.get("inprocess"):
+        try:
+            send_stop_job_command(redis_conn, job_id)
+        except Exception:
+            pass
 
     return {"ok": True, "canceled": False, "already_started": True}
 
@@ -1,31 +1,33 @@
 import cv2
 import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "worker"))
+from videoio import FFmpegReader
 
 # === 輸入影片路徑 ===
 VIDEO_PATH = r"C:\Users\yauka\OneDrive\桌面\highlight.mp4"
 OUTPUT_PATH = os.path.splitext(VIDEO_PATH)[0] + "_660x360.mp4"
 
-# === 讀取影片 ===
-cap = cv2.VideoCapture(VIDEO_PATH)
-
-# 取得原始 FPS
-fps = int(cap.get(cv2.CAP_PROP_FPS))
-
 # 設定新的尺寸
 new_width = 660
 new_height = 360
 
+# === 讀取影片（縮放在 ffmpeg 內完成，不必逐格 cv2.resize）===
+cap = FFmpegReader(VIDEO_PATH, size=(new_width, new_height), reuse_buffer=True)
+
+# 取得原始 FPS
+fps = int(cap.get(cv2.CAP_PROP_FPS))
+
 # 影片編碼器設定
 fourcc = cv2.VideoWriter_fourcc(*'mp4v')
 out = cv2.VideoWriter(OUTPUT_PATH, fourcc, fps, (new_width, new_height))
 
 while True:
-    ret, frame = cap.read()
+    ret, resized_frame = cap.read()
     if not ret:
         break
 
-    # 重新調整大小
-    resized_frame = cv2.resize(frame, (new_width, new_height), interpolation=cv2.INTER_AREA)
     out.write(resized_frame)
 
 cap.release()
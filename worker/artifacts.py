@@ -0,0 +1,152 @@
+# worker/artifacts.py
+# 內容定址的中間產物快取：同一支上傳影片換個選項重送（例如只切換 superResolution）時，
+# 偵測 / CLAHE / firmRoot 這些不受影響的階段直接下載上次的結果，不再重跑。
+# key = 來源物件（ETag + 大小）+ 階段名稱 + 階段參數（權重 / 程式檔的 sha256、img size、conf…）
+# 存在 exports bucket 的 <prefix>/<stage>/<hash>/ 底下：files/<相對路徑> + manifest.json（最後寫，有它才算完整）。
+# 命中時把 manifest 原地複製一次更新 LastModified，超過容量就從最久沒用的開始刪（LRU）。
+import hashlib, json, os, time
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+ARTIFACTS_PREFIX = os.getenv("ARTIFACTS_PREFIX", "cache/artifacts")
+ARTIFACTS_MAX_GB = float(os.getenv("ARTIFACTS_MAX_GB", "20"))  # 超過就 LRU 淘汰
+ARTIFACTS_VERSION = os.getenv("ARTIFACTS_VERSION", "1")  # 改這個值讓所有舊快取失效（例如換了 firmRoot 程式）
+
+_digests: dict = {}
+
+
+def file_digest(path) -> str:
+    """檔案 sha256；同一行程內以 (路徑, 大小, mtime) 記住，權重檔不用每個 job 重讀"""
+    st = os.stat(path)
+    stamp = (str(Path(path).resolve()), st.st_size, st.st_mtime_ns)
+    if stamp not in _digests:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        _digests[stamp] = h.hexdigest()
+    return _digests[stamp]
+
+
+def code_digest(paths) -> str:
+    """一組程式檔（可含目錄，取底下所有 *.py）合併的 sha256：改了任何一支，該階段的快取就失效"""
+    files = []
+    for p in map(Path, paths):
+        files += sorted(p.rglob("*.py")) if p.is_dir() else [p] if p.is_file() else []
+    h = hashlib.sha256()
+    for f in files:
+        h.update(f"{f.name}:{file_digest(f)}\n".encode())
+    return h.hexdigest()
+
+
+def source_digest(s3, bucket: str, key: str) -> Optional[str]:
+    """S3 物件的識別：ETag + 大小（同一份上傳重送時不變）；查不到回傳 None（不使用快取）"""
+    try:
+        head = s3.head_object(Bucket=bucket, Key=key)
+    except (ClientError, BotoCoreError):
+        return None
+    return f"{head.get('ETag', '').strip(chr(34))}:{head.get('ContentLength', 0)}"
+
+
+class ArtifactStore:
+    def __init__(self, s3, bucket: str, prefix: str = ARTIFACTS_PREFIX, max_bytes: Optional[int] = None,
+                 log: Callable[[str], None] = print):
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.max_bytes = int(ARTIFACTS_MAX_GB * (1 << 30)) if max_bytes is None else max_bytes
+        self.log = log
+
+    def key(self, stage: str, source: str, params: dict) -> str:
+        blob = json.dumps({"source": source, "params": params, "version": ARTIFACTS_VERSION}, sort_keys=True)
+        return f"{stage}/{hashlib.sha256(blob.encode()).hexdigest()[:24]}"
+
+    def _manifest(self, key: str) -> str:
+        return f"{self.prefix}/{key}/manifest.json"
+
+    def fetch(self, key: str, dest: Path) -> Optional[Dict[str, Path]]:
+        """命中：下載到 dest（保留相對路徑）並回傳 {相對路徑: 本機路徑}；沒有或失敗回傳 None"""
+        try:
+            manifest = json.loads(self.s3.get_object(Bucket=self.bucket, Key=self._manifest(key))["Body"].read())
+        except (ClientError, BotoCoreError, ValueError):
+            return None
+        try:
+            out = {}
+            for rel in manifest.get("files", {}):
+                p = Path(dest) / rel
+                p.parent.mkdir(parents=True, exist_ok=True)
+                self.s3.download_file(self.bucket, f"{self.prefix}/{key}/files/{rel}", str(p))
+                out[rel] = p
+            self._touch(key)
+        except (ClientError, BotoCoreError, OSError) as e:
+            self.log(f"[artifacts] fetch {key} failed: {e}")
+            return None
+        self.log(f"[artifacts] hit {key} ({len(out)} files)")
+        return out
+
+    def store(self, key: str, files: Dict[str, Path]) -> bool:
+        """上傳 {相對路徑: 本機路徑}；快取失敗不影響 job，只記 log"""
+        try:
+            sizes = {}
+            for rel, p in files.items():
+                self.s3.upload_file(str(p), self.bucket, f"{self.prefix}/{key}/files/{rel}")
+                sizes[rel] = Path(p).stat().st_size
+            body = json.dumps({"files": sizes, "created": time.time()}).encode()
+            self.s3.put_object(Bucket=self.bucket, Key=self._manifest(key), Body=body,
+                               ContentType="application/json")
+        except (ClientError, BotoCoreError, OSError) as e:
+            self.log(f"[artifacts] store {key} failed: {e}")
+            return False
+        self.log(f"[artifacts] stored {key} ({sum(sizes.values())} bytes)")
+        self.evict()
+        return True
+
+    def _touch(self, key: str):
+        # S3 沒有 atime：把 manifest 複製到自己身上（REPLACE metadata）來更新 LastModified
+        self.s3.copy_object(Bucket=self.bucket, Key=self._manifest(key),
+                            CopySource={"Bucket": self.bucket, "Key": self._manifest(key)},
+                            Metadata={"used": str(int(time.time()))}, MetadataDirective="REPLACE",
+                            ContentType="application/json")
+
+    def evict(self, stale_after: float = 3600.0):
+        """總量超過 max_bytes 時，依 manifest 的 LastModified 從最舊的整組刪；沒有 manifest 又超過
+        stale_after 秒的（上傳到一半中斷）一律刪"""
+        entries: Dict[str, dict] = {}
+        try:
+            pages = self.s3.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=self.prefix + "/")
+            for page in pages:
+                for o in page.get("Contents", []):
+                    parts = o["Key"][len(self.prefix) + 1:].split("/")
+                    if len(parts) < 3:
+                        continue
+                    e = entries.setdefault("/".join(parts[:2]), {"keys": [], "size": 0, "used": None, "newest": 0.0})
+                    e["keys"].append(o["Key"])
+                    e["size"] += o["Size"]
+                    t = o["LastModified"].timestamp()
+                    e["newest"] = max(e["newest"], t)
+                    if parts[2] == "manifest.json":
+                        e["used"] = t
+        except (ClientError, BotoCoreError) as e:
+            self.log(f"[artifacts] evict list failed: {e}")
+            return
+
+        now = time.time()
+        doomed = [k for k, e in entries.items() if e["used"] is None and now - e["newest"] > stale_after]
+        total = sum(e["size"] for k, e in entries.items() if k not in doomed)
+        for k, e in sorted(((k, e) for k, e in entries.items() if e["used"] is not None), key=lambda kv: kv[1]["used"]):
+            if total <= self.max_bytes:
+                break
+            doomed.append(k)
+            total -= e["size"]
+        for k in doomed:
+            keys = entries[k]["keys"]
+            try:
+                for i in range(0, len(keys), 1000):
+                    self.s3.delete_objects(Bucket=self.bucket,
+                                           Delete={"Objects": [{"Key": x} for x in keys[i:i + 1000]], "Quiet": True})
+            except (ClientError, BotoCoreError) as e:
+                self.log(f"[artifacts] evict {k} failed: {e}")
+                continue
+            self.log(f"[artifacts] evicted {k} ({entries[k]['size']} bytes)")
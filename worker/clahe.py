@@ -1,8 +1,12 @@
 #clahe.py PROC_VIDEO_PATH的來源
-import os, json, cv2, numpy as np
+import os, sys, json, cv2, numpy as np
 from typing import Dict, List, Tuple, Optional
 from tqdm import tqdm
 
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from videoio import open_video
+from detarrays import Detections
+
 VIDEO_PATH   = r"C:\Users\yauka\OneDrive\桌面\PYfile\All_Data\Project_root\data\video17s.mp4"
 TRACKING_JSON = r"C:\Users\yauka\OneDrive\桌面\PYfile\All_Data\Project_root\data\video17s.json"
 OUTPUT_DIR   = r"C:\Users\yauka\OneDrive\桌面\PYfile\All_Data\firmRoot\tools"
@@ -86,11 +90,14 @@ class RoiClaheApplier:
         cv2.merge((y_eq, cr, cb), dst=self._ycrcb)
         cv2.cvtColor(self._ycrcb, cv2.COLOR_YCrCb2BGR, dst=roi)
 
-def load_tracking(tracking_json_path: str) -> Dict[str, dict]:
+def load_tracking(tracking_json_path: str):
+    """舊的 detect.json → dict；欄式的 detect.npz → Detections（同樣支援 .get(str(frame), {})）"""
     if not os.path.exists(tracking_json_path):
         print(f"[警告] 找不到 TRACKING_JSON：{tracking_json_path}")
         return {}
     try:
+        if tracking_json_path.lower().endswith(".npz"):
+            return Detections.load(tracking_json_path)
         with open(tracking_json_path, "r", encoding="utf-8") as f:
             data = json.load(f)
         if isinstance(data, dict):
@@ -108,7 +115,8 @@ def export_video_roi_clahe_from_json(
 ) -> None:
     tracking_data = load_tracking(tracking_json_path)
 
-    cap = cv2.VideoCapture(video_path)
+    # cv2 打不開時改走 ffmpeg rawvideo；frame 只在本迴圈內就地處理後寫出，可重用 buffer
+    cap = open_video(video_path, reuse_buffer=True)
     if not cap.isOpened():
         print("[錯誤] 無法開啟影片！"); return
 
@@ -124,6 +132,7 @@ def export_video_roi_clahe_from_json(
         print("[錯誤] 無法建立輸出檔案！"); cap.release(); return
 
     roi_clahe = RoiClaheApplier()
+    person_cls = tracking_data.class_index("person") if isinstance(tracking_data, Detections) else -1
     pbar = tqdm(total=total if total > 0 else None, desc=f"{effect_name}", unit="f")
 
     frame_idx = 0
@@ -133,11 +142,16 @@ def export_video_roi_clahe_from_json(
             if not ret:
                 break
 
-            rec = tracking_data.get(str(frame_idx), {})
-            persons_raw = rec.get("person", []) or []
-
             # 轉換 + 分數門檻
             persons_xyxy = []
+            if isinstance(tracking_data, Detections):  # 欄式：直接 slice 該格的 person 列
+                xyxy, scores = tracking_data.boxes(frame_idx, person_cls)
+                persons_xyxy = [(*map(float, b), s) for b, s in zip(xyxy.tolist(), scores.tolist()) if s >= PERSON_SCORE_THR]
+                persons_raw = []
+            else:
+                rec = tracking_data.get(str(frame_idx), {})
+                persons_raw = rec.get("person", []) or []
+
             for item in persons_raw:
                 if not (isinstance(item, list) and len(item) >= 3):
                     continue
@@ -0,0 +1,150 @@
+# worker/cpuslots.py
+# 主機層級的 CPU 分配：同一台機器上多個 RQ worker 的子行程（detect.py / Real-ESRGAN / ffmpeg / firmRoot）
+# 各自以為整台機器都是自己的（torch / OpenMP / ffmpeg 預設開滿核心），一起跑就嚴重超賣。
+# 每個子行程啟動前先在共用目錄（CPUSLOTS_DIR，所有 worker 容器掛同一個 volume）登記一份租約，
+# 主機核心預先平均切成 CPUSLOTS_WORKERS 份（同機同時跑的 worker 數），每個租約拿一份沒人用的：
+# CPU affinity + OMP/MKL 執行緒數 + ffmpeg -threads + detect.py --threads。各份互不重疊，
+# 已經在跑的子行程不需要縮小就不會超賣；租約比份數多時才會與最少人用的那份共用。
+import fcntl, json, os, socket, time, uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List, Optional
+
+CPUSLOTS_DIR = os.getenv("CPUSLOTS_DIR", "")  # 空字串 = 關閉（子行程照舊用預設執行緒數）
+CPUSLOTS_TTL = float(os.getenv("CPUSLOTS_TTL", "30"))  # 租約多久沒 heartbeat 視為死掉（worker 被 kill -9）
+CPUSLOTS_CORES = os.getenv("CPUSLOTS_CORES", "")  # 可分配的核心，例如 "0-15"；空 = 本行程的 affinity
+CPUSLOTS_WORKERS = int(os.getenv("CPUSLOTS_WORKERS") or 0)  # 同機 worker 數 = 核心切成幾份；0 = 關閉
+
+_THREAD_ENV = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS")
+
+
+def _parse_cores(s: str) -> List[int]:
+    cores = []
+    for part in s.replace(" ", "").split(","):
+        if "-" in part:
+            a, b = part.split("-")
+            cores += range(int(a), int(b) + 1)
+        elif part:
+            cores.append(int(part))
+    return sorted(set(cores))
+
+
+def host_cores() -> List[int]:
+    if CPUSLOTS_CORES:
+        return _parse_cores(CPUSLOTS_CORES)
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+class CpuLease:
+    """一個子行程持有的核心；release() 或 with 區塊結束時歸還"""
+
+    def __init__(self, path: Optional[Path], stage: str, cores: List[int]):
+        self.path = path
+        self.stage = stage
+        self.cores = cores
+        self.threads = max(len(cores), 1)
+        self.last_beat = time.time()
+
+    def env(self, base: Optional[dict] = None) -> dict:
+        env = dict(os.environ if base is None else base)
+        env.update({k: str(self.threads) for k in _THREAD_ENV})
+        return env
+
+    def preexec(self):
+        """Popen(preexec_fn=...) 在子行程 exec 前呼叫：綁核心（子孫行程會繼承）"""
+        if hasattr(os, "sched_setaffinity") and self.cores:
+            os.sched_setaffinity(0, self.cores)
+
+    def apply(self, cmd: List[str]) -> List[str]:
+        """依工具補上執行緒參數：ffmpeg 在輸出檔前加 -threads；detect.py 加 --threads / --ort-threads"""
+        cmd = list(cmd)
+        if cmd and Path(cmd[0]).name.startswith("ffmpeg") and len(cmd) > 1 and "-threads" not in cmd:
+            cmd[-1:-1] = ["-threads", str(self.threads)]
+        elif any(Path(c).name == "detect.py" for c in cmd[:3]):
+            cmd += ["--threads", str(self.threads), "--ort-threads", str(self.threads)]  # argparse 後者優先
+        return cmd
+
+    def heartbeat(self, interval: float = 5.0):
+        """長時間的子行程要定期呼叫（_run_cancellable 的輪詢迴圈），不然會被當成死掉的租約"""
+        now = time.time()
+        if self.path is not None and now - self.last_beat >= interval:
+            try:
+                os.utime(self.path)
+            except OSError:
+                pass
+            self.last_beat = now
+
+    def release(self):
+        if self.path is not None:
+            try:
+                self.path.unlink()
+            except FileNotFoundError:
+                pass
+            self.path = None
+
+    def __repr__(self):
+        return f"CpuLease({self.stage}, {self.threads} threads, cores={self.cores})"
+
+
+def _live_leases(d: Path) -> List[dict]:
+    leases, now = [], time.time()
+    for f in d.glob("*.json"):
+        try:
+            if now - f.stat().st_mtime > CPUSLOTS_TTL:
+                f.unlink()  # 持有者已經不在了
+                continue
+            leases.append(json.loads(f.read_text()))
+        except (OSError, ValueError):
+            continue
+    return leases
+
+
+def slots(cores: List[int], n: int) -> List[List[int]]:
+    """cores 依序切成 n 份連續的核心（前面幾份多一顆）；核心比 n 少時份數跟著變少"""
+    n = max(1, min(n, len(cores)))
+    size, extra = divmod(len(cores), n)
+    out, i = [], 0
+    for k in range(n):
+        j = i + size + (k < extra)
+        out.append(cores[i:j])
+        i = j
+    return out
+
+
+def acquire(stage: str) -> Optional[CpuLease]:
+    """
+    分到 CPUSLOTS_WORKERS 份核心中目前最少租約使用的一份（同數取編號小的）。
+    未設定 CPUSLOTS_DIR 或 CPUSLOTS_WORKERS 時回傳 None（不做任何限制）。
+    """
+    if not CPUSLOTS_DIR or CPUSLOTS_WORKERS <= 0:
+        return None
+    d = Path(CPUSLOTS_DIR)
+    d.mkdir(parents=True, exist_ok=True)
+    parts = slots(host_cores(), CPUSLOTS_WORKERS)
+    with open(d / ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)  # 同一台主機的 worker 之間互斥
+        try:
+            used = [0] * len(parts)
+            for l in _live_leases(d):
+                if 0 <= l.get("slot", -1) < len(parts):
+                    used[l["slot"]] += 1
+            slot = min(range(len(parts)), key=lambda i: (used[i], i))
+            mine = parts[slot]
+            path = d / f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}.json"
+            path.write_text(json.dumps({"stage": stage, "slot": slot, "cores": mine, "since": time.time()}))
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return CpuLease(path, stage, mine)
+
+
+@contextmanager
+def lease(stage: str):
+    """with lease("detect") as l: ...；l 為 None 表示功能關閉"""
+    l = acquire(stage)
+    try:
+        yield l
+    finally:
+        if l is not None:
+            l.release()
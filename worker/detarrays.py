@@ -0,0 +1,176 @@
+# worker/detarrays.py
+# 偵測結果的欄式格式：frame_idx/cls/x1/y1/x2/y2/conf/flags 各一個 numpy 陣列 + 每格 offset 索引
+# 取代巢狀的 detect.json（{frame: {class: [[[x1,y1],[x2,y2],conf], ...]}}），可互相轉換
+import json
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+FLAG_INTERP = 1  # 影格間內插（detect.py --frame-stride）
+FLAG_REUSED = 2  # 畫面靜止，沿用上一次推論的結果（detect.py --motion-gate）
+_FLAG_TAGS = {"interp": FLAG_INTERP, "reused": FLAG_REUSED}
+
+class Detections:
+    """
+    rows 依 frame 排序；frame f 的資料在 [offsets[f], offsets[f+1])，取單格是 O(1) slice。
+    """
+
+    COLUMNS = ("frame_idx", "cls", "x1", "y1", "x2", "y2", "conf", "flags")
+
+    def __init__(self, frame_idx, cls, x1, y1, x2, y2, conf, flags, names: List[str], offsets=None,
+                 n_frames: int = 0):
+        self.frame_idx = np.asarray(frame_idx, dtype=np.int32)
+        self.cls = np.asarray(cls, dtype=np.int16)
+        self.x1 = np.asarray(x1, dtype=np.int32)
+        self.y1 = np.asarray(y1, dtype=np.int32)
+        self.x2 = np.asarray(x2, dtype=np.int32)
+        self.y2 = np.asarray(y2, dtype=np.int32)
+        self.conf = np.asarray(conf, dtype=np.float32)
+        self.flags = np.asarray(flags, dtype=np.uint8)
+        self.names = list(names)
+        if offsets is None:
+            n_frames = max(n_frames, int(self.frame_idx.max()) + 1 if len(self.frame_idx) else 0)
+            offsets = np.searchsorted(self.frame_idx, np.arange(n_frames + 1), side="left")
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1  # 影格數
+
+    @property
+    def num_boxes(self) -> int:
+        return len(self.frame_idx)
+
+    # ---------- 讀取 ----------
+    def rows(self, frame: int) -> slice:
+        if frame < 0 or frame >= len(self):
+            return slice(0, 0)
+        return slice(int(self.offsets[frame]), int(self.offsets[frame + 1]))
+
+    def boxes(self, frame: int, cls: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """回傳 (xyxy (n,4) int32, conf (n,) float32)；cls 可只取某一類"""
+        r = self.rows(frame)
+        xyxy = np.stack((self.x1[r], self.y1[r], self.x2[r], self.y2[r]), 1)
+        conf = self.conf[r]
+        if cls is not None:
+            m = self.cls[r] == cls
+            return xyxy[m], conf[m]
+        return xyxy, conf
+
+    def class_index(self, name: str) -> int:
+        return self.names.index(name) if name in self.names else -1
+
+    def frame_legacy(self, frame: int) -> Dict[str, list]:
+        """單格轉回舊格式 {class: [[[x1,y1],[x2,y2],conf], ...]}"""
+        r = self.rows(frame)
+        out: Dict[str, list] = {}
+        for c, a, b, x, y, s, f in zip(self.cls[r].tolist(), self.x1[r].tolist(), self.y1[r].tolist(),
+                                       self.x2[r].tolist(), self.y2[r].tolist(), self.conf[r].tolist(),
+                                       self.flags[r].tolist()):
+            box = [[a, b], [x, y], s]
+            if f & FLAG_INTERP:
+                box.append("interp")
+            elif f & FLAG_REUSED:
+                box.append("reused")
+            out.setdefault(self.names[c], []).append(box)
+        return out
+
+    def get(self, key, default=None):
+        """與舊的 dict 相容：tracking.get(str(frame_idx), {})"""
+        try:
+            frame = int(key)
+        except (TypeError, ValueError):
+            return default
+        if frame < 0 or frame >= len(self):
+            return default
+        return self.frame_legacy(frame)
+
+    # ---------- 存讀檔 ----------
+    def save(self, path: str) -> str:
+        np.savez(path, offsets=self.offsets, names=np.array(self.names, dtype=str),
+                 **{k: getattr(self, k) for k in self.COLUMNS})
+        return str(path)
+
+    @classmethod
+    def load(cls, path: str) -> "Detections":
+        with np.load(path, allow_pickle=False) as z:
+            return cls(*(z[k] for k in cls.COLUMNS), names=z["names"].tolist(), offsets=z["offsets"])
+
+    # ---------- 與舊 JSON 互轉 ----------
+    @classmethod
+    def from_records(cls, records: Iterable[Tuple[str, dict]], names: Optional[List[str]] = None,
+                     chunk: int = 1 << 16) -> "Detections":
+        """records：(frame, {class: [[[x1,y1],[x2,y2],conf(,tag)], ...]}) 序列，例如 legacy.items() 或 iter_jsonl()。
+        每累積 chunk 列就轉成 numpy 欄位，整場比賽（數百萬個框）也不會留下一堆 Python 物件"""
+        names = list(names or [])
+        index = {n: i for i, n in enumerate(names)}
+        dtypes = (np.int32, np.int16, np.int32, np.int32, np.int32, np.int32, np.float32, np.uint8)
+        chunks: List[List[np.ndarray]] = [[] for _ in cls.COLUMNS]
+        rows: list = []
+        n_frames = 0
+
+        def flush():
+            if rows:
+                for col, a, dt in zip(chunks, zip(*rows), dtypes):
+                    col.append(np.asarray(a, dtype=dt))
+                rows.clear()
+
+        for frame, rec in records:
+            f = int(frame)
+            n_frames = max(n_frames, f + 1)
+            for name, items in (rec or {}).items():
+                if name not in index:
+                    index[name] = len(names)
+                    names.append(name)
+                c = index[name]
+                for item in items or []:
+                    if not (isinstance(item, list) and len(item) >= 3):
+                        continue
+                    (x1, y1), (x2, y2), sc = item[:3]
+                    rows.append((f, c, x1, y1, x2, y2, sc, _FLAG_TAGS.get(item[3], 0) if len(item) > 3 else 0))
+            if len(rows) >= chunk:
+                flush()
+        flush()
+        cols = [np.concatenate(col) if col else np.zeros(0, dt) for col, dt in zip(chunks, dtypes)]
+        if len(cols[0]) and (np.diff(cols[0]) < 0).any():  # 串流輸出 / 分片合併本來就依 frame 排序，不用再複製一份
+            order = np.argsort(cols[0], kind="stable")
+            cols = [c[order] for c in cols]
+        return cls(*cols, names=names, n_frames=n_frames)
+
+    @classmethod
+    def from_json(cls, path: str, names: Optional[List[str]] = None) -> "Detections":
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls.from_records(data.items(), names)
+
+    def to_legacy(self) -> Dict[str, dict]:
+        return {str(f): self.frame_legacy(f) for f in range(len(self))}
+
+    def to_json(self, path: str) -> str:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_legacy(), f)
+        return str(path)
+
+    # ---------- 前端疊圖軌 ----------
+    def to_overlay(self, fps: float, width: int = 0, height: int = 0, min_conf: float = 0.0) -> dict:
+        """
+        播放器端自己畫框用的精簡軌（取代燒進畫面的 detect_annotated.mp4）：
+        {"fps", "width", "height", "names", "frames": [[t_ms, [[cls, x1, y1, x2, y2, conf%, flags], ...]], ...]}
+        t_ms = frame / fps * 1000；沒有框的影格不列出
+        """
+        keep = self.conf >= min_conf
+        conf = np.rint(self.conf * 100).astype(np.int32)
+        frames = []
+        for f in range(len(self)):
+            r = self.rows(f)
+            m = keep[r]
+            if not m.any():
+                continue
+            cols = (self.cls[r][m], self.x1[r][m], self.y1[r][m], self.x2[r][m], self.y2[r][m], conf[r][m],
+                    self.flags[r][m])
+            frames.append([int(round(f * 1000 / fps)) if fps else f, np.stack(cols, 1).tolist()])
+        return {"fps": fps, "width": int(width), "height": int(height), "names": self.names, "frames": frames}
+
+    def save_overlay(self, path: str, fps: float, width: int = 0, height: int = 0, min_conf: float = 0.0) -> str:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_overlay(fps, width, height, min_conf), f, separators=(",", ":"))
+        return str(path)
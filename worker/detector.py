@@ -0,0 +1,63 @@
+# worker/detector.py
+# 常駐偵測服務：同一個 worker 行程只載入一次 YOLO 模型（torch import / 讀權重 / fuse 只付一次），
+# detect_video() 直接在行程內跑 yolo_dt/detect.py 的 detect()，輸出與子行程版完全相同（同一份程式、同樣參數）
+# 注意：rq 預設 Worker 每個 job 都 fork 新的 work-horse，模型會跟著 work-horse 消失；
+#       要真正重用需以 SimpleWorker 啟動（RQ_WORKER_CLASS=rq.SimpleWorker）
+import os, sys, threading
+from pathlib import Path
+from typing import Callable, Optional
+
+DETECT_PY_PATH = os.getenv("DETECT_PY_PATH", "/app/yolo_dt/detect.py")
+
+class DetectCanceled(Exception):
+    """由 progress callback 拋出，detect() 會先關好檔案再往外傳"""
+
+_lock = threading.Lock()
+_detectors: dict = {}
+
+def _detect_module():
+    d = str(Path(DETECT_PY_PATH).resolve().parent)
+    if d not in sys.path:
+        sys.path.insert(0, d)  # yolo_dt 的 models/、utils/ 是頂層 package
+    import detect
+    return detect
+
+class Detector:
+    """持有已載入的模型；同一時間只跑一支影片"""
+
+    def __init__(self, args: list):
+        self.detect = _detect_module()
+        import torch
+        from utils.torch_utils import select_device
+        self.torch = torch
+        opt = self.detect.parse_opt(list(args))
+        self.device = select_device(opt.device)
+        with torch.no_grad():
+            self.model = self.detect.load_detect_model(opt, self.device)
+        self.lock = threading.Lock()
+
+    def detect_video(self, path: str, args: list,
+                     progress: Optional[Callable[[int, Optional[int]], None]] = None) -> dict:
+        """args 與 detect.py 命令列相同（不含 --source）；回傳 {'dir','video','json','npz'}"""
+        opt = self.detect.parse_opt([*args, "--source", str(path)])
+        with self.lock, self.torch.no_grad():
+            return self.detect.detect(opt, model=self.model, progress=progress)
+
+def _model_key(args: list) -> tuple:
+    """決定模型內容的參數；其他參數（conf、batch、輸出路徑…）每次呼叫可不同"""
+    opt = _detect_module().parse_opt(list(args))
+    return (tuple(opt.weights) if isinstance(opt.weights, list) else opt.weights, opt.backend, opt.device,
+            opt.img_size, opt.model_cache, opt.cache_traced, opt.ort_threads, opt.exec_mode)
+
+def get_detector(args: list) -> Detector:
+    key = _model_key(args)
+    with _lock:
+        det = _detectors.get(key)
+        if det is None:
+            _detectors.clear()  # 換權重就放掉舊模型
+            det = _detectors[key] = Detector(args)
+        return det
+
+def detect_video(path: str, args: list, progress: Optional[Callable[[int, Optional[int]], None]] = None) -> dict:
+    """args：detect.py 的命令列參數（不含 python / detect.py / --source）"""
+    return get_detector(args).detect_video(path, args, progress=progress)
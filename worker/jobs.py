@@ -8,15 +8,58 @@ from botocore.client import Config
 from botocore.exceptions import ClientError
 from rq import get_current_job
 
+import artifacts
+import cpuslots
+
 # 環境變數(可用.env 覆蓋)
 S3_ENDPOINT     = os.getenv("S3_ENDPOINT", "http://minio:9000")
 S3_REGION       = os.getenv("S3_REGION", "us-east-1")
 
 DETECT_PY_PATH  = os.getenv("DETECT_PY_PATH", "/app/yolo_dt/detect.py")
 YOLO_WEIGHTS    = os.getenv("YOLO_WEIGHTS",   "/models/yolo_dt/ob_game.pt")
+YOLO_ENSEMBLE_WEIGHTS = os.getenv("YOLO_ENSEMBLE_WEIGHTS", "").split()  # 額外的 .pt（例如球專用模型），與 YOLO_WEIGHTS 平行推論後合併再 NMS
+YOLO_ENSEMBLE_IMGSZ   = os.getenv("YOLO_ENSEMBLE_IMGSZ", "").split()    # 每個成員的推論尺寸（含 YOLO_WEIGHTS），0 = YOLO_IMGSZ
+YOLO_ENSEMBLE_CLASSES = os.getenv("YOLO_ENSEMBLE_CLASSES", "").split()  # 每個成員負責的類別，例如 "person ball"，all = 全部
 YOLO_IMGSZ      = int(os.getenv("YOLO_IMGSZ", "1280"))
 YOLO_CONF       = float(os.getenv("YOLO_CONF","0.06"))
+YOLO_BATCH      = int(os.getenv("YOLO_BATCH", "1"))     # 每次 forward 的影格數
+YOLO_PREFETCH   = int(os.getenv("YOLO_PREFETCH", "4"))  # 背景解碼佇列深度，0 = 關閉
+YOLO_RENDER_SCALE = os.getenv("YOLO_RENDER_SCALE", "1.0")  # 標註影片解析度倍率（背景執行緒繪製 / 編碼）
+YOLO_RENDER_QUEUE = os.getenv("YOLO_RENDER_QUEUE", "16")   # 標註影片佇列，全滿時等編碼器（每格都畫框、不丟幀，影片與原片逐格對齊）
+YOLO_FRAME_STRIDE = int(os.getenv("YOLO_FRAME_STRIDE", "1"))        # 每 K 格才跑偵測，其餘內插
+YOLO_BACKEND    = os.getenv("YOLO_BACKEND", "torch")  # torch | onnxruntime
+YOLO_ONNX       = os.getenv("YOLO_ONNX", "/models/yolo_dt/ob_game.onnx")  # yolo_dt/export.py 輸出
+YOLO_ORT_THREADS = int(os.getenv("YOLO_ORT_THREADS", "0"))
+YOLO_SHARDS     = int(os.getenv("YOLO_SHARDS", "1"))          # 影片切成 K 段，各段一個 detect.py 行程
+YOLO_SHARD_THREADS = int(os.getenv("YOLO_SHARD_THREADS", "0"))  # 每段的 torch threads，0 = CPU 數 / K
+YOLO_SHARD_RETRIES = int(os.getenv("YOLO_SHARD_RETRIES", "1"))  # 失敗段落重跑次數
+YOLO_TILES      = os.getenv("YOLO_TILES", "")                  # 切塊推論，例如 "2x2"（YOLO_IMGSZ 變成每塊大小）
+YOLO_TILE_OVERLAP = float(os.getenv("YOLO_TILE_OVERLAP", "0.15"))
+YOLO_BALL_REFINE = os.getenv("YOLO_BALL_REFINE", "0") == "1"    # 1 = YOLO_IMGSZ 只負責球員，球另在預測位置附近高解析度偵測
+YOLO_BALL_WINDOW = os.getenv("YOLO_BALL_WINDOW", "480")         # 球視窗大小（原影片像素）
+YOLO_BALL_IMGSZ  = os.getenv("YOLO_BALL_IMGSZ", "640")          # 球視窗推論尺寸
+YOLO_BALL_FULL_IMGSZ = os.getenv("YOLO_BALL_FULL_IMGSZ", "1280")  # 追丟時整張畫面重找的推論尺寸
+YOLO_CASCADE_IMGSZ = os.getenv("YOLO_CASCADE_IMGSZ", "0")       # >0：YOLO_IMGSZ 找不到球的畫格改用此尺寸重跑
+YOLO_CASCADE_CONF  = os.getenv("YOLO_CASCADE_CONF", "0.25")    # 球分數（obj * cls）低於此值才升級
+YOLO_CASCADE_ONNX  = os.getenv("YOLO_CASCADE_ONNX", "")        # 高解析度用的另一個模型（例如該尺寸匯出的 .onnx），空 = 同一個模型（固定尺寸的 .onnx 不行）
+YOLO_BATCHED_NMS = os.getenv("YOLO_BATCHED_NMS", "0") == "1"    # 1 = 整個 batch 一次 batched_nms
+YOLO_CLASS_CONF  = os.getenv("YOLO_CLASS_CONF", "").split()     # 各類別門檻，例如 "ball=0.1 player=0.3"（隱含 batched NMS）
+YOLO_MOTION_GATE = os.getenv("YOLO_MOTION_GATE", "0") == "1"    # 畫面靜止時沿用上一格結果
+YOLO_MOTION_THRES = os.getenv("YOLO_MOTION_THRES", "12")        # 每像素灰階變化門檻
+YOLO_MOTION_AREA  = os.getenv("YOLO_MOTION_AREA", "0.002")      # 變化像素比例門檻
+YOLO_MOTION_MAX_SKIP = os.getenv("YOLO_MOTION_MAX_SKIP", "30")  # 連續沿用上限
+YOLO_MODEL_CACHE = os.getenv("YOLO_MODEL_CACHE", "")  # 已 fuse 的部署模型快取目錄，空字串 = 關閉
+YOLO_CACHE_TRACED = os.getenv("YOLO_CACHE_TRACED", "0") == "1"
+YOLO_EXEC_MODE  = os.getenv("YOLO_EXEC_MODE", "eager")  # CPU 執行模式：eager 或 channels_last,compile,bf16 的組合（啟動自檢失敗會退回 eager）
 ENABLE_DETECT   = os.getenv("ENABLE_DETECT", "1") == "1"
+CAMERA_PROFILES_DIR = os.getenv("CAMERA_PROFILES_DIR", "/models/cameras")  # <name>.json：球場多邊形（options.cameraProfile）
+DETECT_INPROC   = os.getenv("DETECT_INPROC", "0") == "1"  # 1 = 在 worker 行程內偵測（detector.py，模型只載入一次）
+RQ_NO_FORK      = os.getenv("RQ_WORKER_CLASS", "").endswith("SimpleWorker")  # job 跑在 worker 行程本身（沒有 work-horse）
+ARTIFACTS_ENABLE = os.getenv("ARTIFACTS_ENABLE", "1") == "1"  # 偵測 / CLAHE / firmRoot 結果依內容快取（artifacts.py）
+DETECT_ANNOTATED_MP4 = os.getenv("DETECT_ANNOTATED_MP4", "1") == "1"  # 0 = 不產生標註影片，只發布 overlay.json（options.overlay 同效果）
+OVERLAY_MIN_CONF = float(os.getenv("OVERLAY_MIN_CONF", "0.1"))  # overlay.json 只收 conf ≥ 此值的框
+
+VIDEO_DECODER   = os.getenv("VIDEO_DECODER", "auto")  # auto | cv2 | ffmpeg
 
 CLAHE_PY_PATH   = os.getenv("CLAHE_PY_PATH", "/app/clahe.py")
 ENABLE_CLAHE    = os.getenv("ENABLE_CLAHE", "1") == "1"
@@ -177,10 +220,30 @@ def _pick_first(p: Path, pattern: str) -> Optional[Path]:
 # 取消子行程
 def _run_cancellable(cmd: list[str], cwd: Optional[str] = None, log_prefix: str = "",
                      soft_kill_timeout: float = 8.0, poll_interval: float = 0.5) -> int:
+    # 主機 CPU 分配（cpuslots.py）：每個子行程綁一份不重疊的核心 / 執行緒，CPUSLOTS_WORKERS 未設定則不限制
+    lease = cpuslots.acquire(log_prefix.strip(" []") or Path(cmd[0]).name)
+    try:
+        return _run_cancellable_leased(cmd, cwd, log_prefix, soft_kill_timeout, poll_interval, lease)
+    finally:
+        if lease is not None:
+            lease.release()
+
+def _run_cancellable_leased(cmd: list[str], cwd: Optional[str], log_prefix: str, soft_kill_timeout: float,
+                            poll_interval: float, lease: Optional[cpuslots.CpuLease]) -> int:
     preexec = os.setsid if hasattr(os, "setsid") else None  # Linux: 建立新 process group
+    env = None
+    if lease is not None:
+        cmd = lease.apply(cmd)
+        env = lease.env()
+        _log(f"{log_prefix}cpu: {lease}")
+        if preexec is not None:
+            def preexec():
+                os.setsid()
+                lease.preexec()
     proc = subprocess.Popen(
         cmd,
         cwd=cwd,
+        env=env,
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
         text=True,
@@ -238,6 +301,8 @@ def _run_cancellable(cmd: list[str], cwd: Optional[str] = None, log_prefix: str
 
             if time.time() - last_flush > 0.5:
                 _flush()
+            if lease is not None:
+                lease.heartbeat()
 
             rc = proc.poll()
             if rc is not None:
@@ -313,7 +378,7 @@ def _fixup_mp4(input_path: Path, output_path: Path) -> bool:
     return rc == 0
 
 def _ensure_cv2_friendly(input_path: Path, workdir: Path) -> Path:
-    """若 OpenCV 打不開，先轉一份 H.264+yuv420p 的 mp4 再回傳那份。"""
+    """若 OpenCV 打不開，先轉一份 H.264+yuv420p 的 mp4 再回傳那份（給 firmRoot 用；偵測/CLAHE 走 videoio 不需要）。"""
     import cv2, subprocess
     cap = cv2.VideoCapture(str(input_path))
     if cap.isOpened():
@@ -337,8 +402,86 @@ def _ensure_cv2_friendly(input_path: Path, workdir: Path) -> Path:
     _log("[pre-fix] produced cv2-friendly mp4")
     return out_fix
 
+# 鏡位設定檔：只接受檔名（不含路徑），找不到就不套 ROI
+def _camera_profile(name: Optional[str]) -> Optional[Path]:
+    if not name:
+        return None
+    if not all(c.isalnum() or c in "-_" for c in str(name)):
+        _log(f"[detect] invalid camera profile name: {name!r}")
+        return None
+    p = Path(CAMERA_PROFILES_DIR) / f"{name}.json"
+    if not p.exists():
+        _log(f"[detect] camera profile not found: {p}")
+        return None
+    return p
+
+# 行程內偵測：模型常駐（detector.py），取消與進度改由每格的 callback 處理
+def _run_detect_inproc(input_mp4: Path, args: list[str], check_interval: float = 0.5) -> int:
+    from detector import DetectCanceled, get_detector
+
+    last = 0.0
+
+    def _progress(frame: int, total: Optional[int]):
+        nonlocal last
+        now = time.time()
+        if now - last < check_interval:
+            return
+        last = now
+        if _should_abort():
+            raise DetectCanceled()
+        _set_meta(detectFrame=frame, detectFrames=total)
+
+    # 主機 CPU 分配：行程內跑時改綁 worker 行程本身，結束後還原 affinity 與 torch 執行緒數
+    # （--ort-threads 不動，否則模型會重新載入）。載入模型、合併分片時不會有進度回呼，
+    # 租約改由背景執行緒固定 heartbeat，才不會超過 CPUSLOTS_TTL 被別的 worker 當成死掉的租約
+    lease = cpuslots.acquire("detect")
+    affinity = os.sched_getaffinity(0) if lease is not None and hasattr(os, "sched_getaffinity") else None
+    torch_threads = None
+    done = threading.Event()
+
+    def _beat():
+        while not done.wait(1.0):
+            lease.heartbeat()
+
+    try:
+        if lease is not None:
+            _log(f"[detect] cpu: {lease}")
+            import torch
+            torch_threads = torch.get_num_threads()
+            threading.Thread(target=_beat, daemon=True).start()
+            args = [*args, "--threads", str(lease.threads)]
+            if affinity is not None:
+                os.sched_setaffinity(0, lease.cores)
+        detector = get_detector(args)  # 第一次或換權重時載入模型，可能要數十秒：載完先看是否已被取消
+        if _should_abort():
+            raise DetectCanceled()
+        out = detector.detect_video(str(input_mp4), args, progress=_progress)
+    except DetectCanceled:
+        _mark_canceled()
+        return -15
+    except Exception as e:
+        _log(f"[detect] in-process error: {e!r}")
+        return 1
+    finally:
+        done.set()
+        if affinity is not None:
+            os.sched_setaffinity(0, affinity)
+        if torch_threads is not None:
+            torch.set_num_threads(torch_threads)
+        if lease is not None:
+            lease.release()
+    _log(f"[detect] outputs: {out}")
+    return 0
+
 # YOLO 偵測
-def _run_detect(input_mp4: Path, workdir: Path, options: dict) -> tuple[Optional[Path], Optional[Path]]:
+def _artifact_key(store: Optional[artifacts.ArtifactStore], stage: str, source_id: Optional[str], params) -> Optional[str]:
+    """store 關閉或來源沒有識別時回傳 None（該階段照常執行、不快取）"""
+    if store is None or not source_id:
+        return None
+    return store.key(stage, source_id, params)
+
+def _run_detect(input_mp4: Path, workdir: Path, options: dict, store: Optional[artifacts.ArtifactStore] = None,
+                source_id: Optional[str] = None) -> tuple[Optional[Path], Optional[Path]]:
     if not (ENABLE_DETECT and options.get("detect", True)):
         _log("[detect] skipped (disabled)")
         return (None, None)
@@ -347,37 +490,91 @@ def _run_detect(input_mp4: Path, workdir: Path, options: dict) -> tuple[Optional
     if not det_py.exists():
         _log(f"[detect] skipped: detect.py not found at {det_py}")
         return (None, None)
-    if not Path(YOLO_WEIGHTS).exists():
-        _log(f"[detect] skipped: weights not found at {YOLO_WEIGHTS}")
+    weights = YOLO_ONNX if YOLO_BACKEND == "onnxruntime" else YOLO_WEIGHTS
+    if not Path(weights).exists():
+        _log(f"[detect] skipped: weights not found at {weights}")
         return (None, None)
 
     out_root = workdir / "runs" / "detect"
     run_name = "fivecut"
-    cmd = [
-        "python", str(det_py),
-        "--weights", str(YOLO_WEIGHTS),
+    members = [w for w in YOLO_ENSEMBLE_WEIGHTS if Path(w).exists()] if YOLO_BACKEND == "torch" else []
+    args = [
+        "--weights", str(weights), *members,
+        "--backend", YOLO_BACKEND,
+        "--ort-threads", str(YOLO_ORT_THREADS),
         "--img-size", str(YOLO_IMGSZ),
-        "--source", str(input_mp4),
         "--conf-thres", str(YOLO_CONF),
+        "--batch-size", str(YOLO_BATCH),
+        "--prefetch", str(YOLO_PREFETCH),
+        "--render-scale", YOLO_RENDER_SCALE,
+        "--render-queue", YOLO_RENDER_QUEUE,
+        "--decoder", VIDEO_DECODER,
+        "--frame-stride", str(YOLO_FRAME_STRIDE),
         "--project", str(out_root),   # 修正：輸出在 workdir/runs/detect/
         "--name", run_name,
         "--exist-ok",
         "--save-json",
+        "--save-npz",
         "--save-txt",
     ]
-    if options.get("augment"): cmd.append("--augment")
-    if options.get("nosave"):  cmd.append("--nosave")
-
-    _log(f"[detect] run: {' '.join(cmd)} (cwd={det_py.parent})")
-    rc = _run_cancellable(cmd, cwd=str(det_py.parent), log_prefix="[detect] ")
-    if rc != 0:
-        if _should_abort():
-            _log("[detect] canceled by user")
+    if YOLO_BATCHED_NMS: args += ["--batched-nms"]
+    if members:
+        if YOLO_ENSEMBLE_IMGSZ: args += ["--ensemble-img-size", *YOLO_ENSEMBLE_IMGSZ]
+        if YOLO_ENSEMBLE_CLASSES: args += ["--ensemble-classes", *YOLO_ENSEMBLE_CLASSES]
+    if YOLO_CLASS_CONF: args += ["--class-conf", *YOLO_CLASS_CONF]
+    if YOLO_BALL_REFINE:
+        args += ["--ball-refine", "--ball-window", YOLO_BALL_WINDOW, "--ball-img-size", YOLO_BALL_IMGSZ,
+                 "--ball-full-size", YOLO_BALL_FULL_IMGSZ]
+    if int(YOLO_CASCADE_IMGSZ or 0) > 0:
+        args += ["--cascade-img-size", YOLO_CASCADE_IMGSZ, "--cascade-conf", YOLO_CASCADE_CONF]
+        if YOLO_CASCADE_ONNX:
+            args += ["--cascade-weights", YOLO_CASCADE_ONNX]
+    if YOLO_MOTION_GATE:
+        args += ["--motion-gate", "--motion-thres", YOLO_MOTION_THRES, "--motion-area", YOLO_MOTION_AREA,
+                 "--motion-max-skip", YOLO_MOTION_MAX_SKIP]
+    if YOLO_TILES: args += ["--tiles", YOLO_TILES, "--tile-overlap", str(YOLO_TILE_OVERLAP)]
+    if YOLO_SHARDS > 1:
+        args += ["--shards", str(YOLO_SHARDS), "--shard-threads", str(YOLO_SHARD_THREADS),
+                 "--shard-retries", str(YOLO_SHARD_RETRIES)]
+    if YOLO_MODEL_CACHE:
+        args += ["--model-cache", YOLO_MODEL_CACHE]
+        if YOLO_CACHE_TRACED: args.append("--cache-traced")
+    if YOLO_EXEC_MODE != "eager": args += ["--exec-mode", YOLO_EXEC_MODE]
+    profile = _camera_profile(options.get("cameraProfile"))
+    if profile: args += ["--roi-profile", str(profile)]
+    if options.get("augment"): args.append("--augment")
+    if options.get("nosave") or options.get("overlay") or not DETECT_ANNOTATED_MP4:
+        args.append("--nosave")  # 不燒框、不編碼；播放器改用 overlay.json 自己畫
+
+    # 快取 key：輸出目錄不算，參數裡的檔案（權重、球場設定…）以內容 sha256 代替路徑；
+    # 再加上 detect.py / yolo_dt 的 models、utils 與它引用的 worker 模組的程式 digest，部署新版偵測程式就不會拿到舊結果
+    run_path = out_root / run_name
+    params = [a for i, a in enumerate(args) if a not in ("--project", "--name") and args[i - 1] not in ("--project", "--name")]
+    code = artifacts.code_digest([det_py, det_py.parent / "models", det_py.parent / "utils",
+                                  Path(__file__).with_name("detarrays.py"), Path(__file__).with_name("videoio.py")])
+    art_key = _artifact_key(store, "detect", source_id, {
+        "args": [artifacts.file_digest(a) if Path(a).is_file() else a for a in params],
+        "code": code,
+    })
+    if art_key and store.fetch(art_key, run_path):
+        _log(f"[detect] reused cached outputs {art_key}")
+    else:
+        if DETECT_INPROC:
+            _log(f"[detect] in-process: {input_mp4} {' '.join(args)}")
+            rc = _run_detect_inproc(input_mp4, args)
         else:
-            _log(f"[detect] failed with code {rc}")
-        return (None, None)
+            cmd = ["python", str(det_py), "--source", str(input_mp4), *args]
+            _log(f"[detect] run: {' '.join(cmd)} (cwd={det_py.parent})")
+            rc = _run_cancellable(cmd, cwd=str(det_py.parent), log_prefix="[detect] ")
+        if rc != 0:
+            if _should_abort():
+                _log("[detect] canceled by user")
+            else:
+                _log(f"[detect] failed with code {rc}")
+            return (None, None)
+        if art_key:  # json / npz / 標註 mp4（labels/ 與 .jsonl 只是中間檔）
+            store.store(art_key, {p.name: p for p in run_path.iterdir() if p.is_file() and p.suffix != ".jsonl"})
 
-    run_path = out_root / run_name
     det_json = _pick_first(run_path, "*.json") or _pick_first(run_path, "*.JSON")
     det_mp4  = _pick_first(run_path, "*.mp4")
     if not det_json:
@@ -390,6 +587,20 @@ def _run_detect(input_mp4: Path, workdir: Path, options: dict) -> tuple[Optional
         _log(f"[detect] mp4  = {det_mp4}")
     return (det_mp4, det_json)
 
+# 疊圖軌：偵測結果轉成以時間戳為 key 的精簡 JSON，跟原影片一起給播放器畫框
+def _write_overlay(video: Path, detections: Path, out_path: Path) -> Optional[Path]:
+    try:
+        from detarrays import Detections
+        from videoio import probe
+        info = probe(str(video))
+        dets = Detections.load(str(detections)) if detections.suffix == ".npz" else Detections.from_json(str(detections))
+        dets.save_overlay(str(out_path), info["fps"], info["width"], info["height"], min_conf=OVERLAY_MIN_CONF)
+    except Exception as e:
+        _log(f"[overlay] failed: {e!r}")
+        return None
+    _log(f"[overlay] {out_path} ({out_path.stat().st_size} bytes)")
+    return out_path
+
 #  CLAHE
 def _run_clahe(input_mp4: Path, tracking_json: Path, workdir: Path, effect_name: str = "WB_CLAHE_JSON_ROI") -> Optional[Path]:
     if not ENABLE_CLAHE:
@@ -511,8 +722,8 @@ def _run_firmroot_pipeline(src_video: Path, tracking_json: Path, workdir: Path,
     logs_dir    = out_root / "logs"
     out_root.mkdir(parents=True, exist_ok=True)
 
-    safe_src   = _ensure_cv2_friendly(src_video, workdir)
-    proc_video = proc_video_override or safe_src
+    # 偵測與 CLAHE 已可直接用 ffmpeg 解碼；只有 firmRoot 要讀原檔時才需要 cv2 相容的轉檔
+    proc_video = proc_video_override or _ensure_cv2_friendly(src_video, workdir)
     _write_firmroot_config(
         fr_dir / "config.py",
         raw_video=src_video,
@@ -565,6 +776,10 @@ def run_auto_edit(
     j = _job()
     job_id = j.get_id() if j else uuid.uuid4().hex
     base_prefix = f"users/{user_sub}/exports/{job_id}"
+    if RQ_NO_FORK:
+        # SimpleWorker 沒有 work-horse（horse_pid 0），rq 的 stop-job 指令會 killpg 到 worker 自己；
+        # 告訴 API 這個 job 只能用 meta 旗標取消
+        _set_meta(inprocess=True)
 
     with tempfile.TemporaryDirectory() as td:
         tdir = Path(td)
@@ -575,14 +790,31 @@ def run_auto_edit(
 
         _abort_checkpoint()
 
+        # 同一支上傳換選項重送時，不受選項影響的階段直接用快取
+        store = artifacts.ArtifactStore(s3, bucket_exports, log=_log) if ARTIFACTS_ENABLE else None
+        source_id = artifacts.source_digest(s3, bucket_videos, source_key) if store else None
+
         # 1) YOLO 偵測
-        det_mp4, det_json = _run_detect(src, tdir, options or {})
+        det_mp4, det_json = _run_detect(src, tdir, options or {}, store=store, source_id=source_id)
         json_key = None
         det_key  = None
+        det_npz  = det_json.with_suffix(".npz") if det_json else None
         if det_json:
             json_key = f"{base_prefix}/detect.json"
             _upload(s3, bucket_exports, json_key, det_json, content_type="application/json")
             _set_meta(jsonKey=json_key)
+        if det_npz and det_npz.exists():
+            npz_key = f"{base_prefix}/detect.npz"
+            _upload(s3, bucket_exports, npz_key, det_npz, content_type="application/octet-stream")
+            _set_meta(npzKey=npz_key)
+        else:
+            det_npz = None
+        overlay_key = None
+        overlay = _write_overlay(src, det_npz or det_json, tdir / "overlay.json") if det_json else None
+        if overlay:
+            overlay_key = f"{base_prefix}/overlay.json"
+            _upload(s3, bucket_exports, overlay_key, overlay, content_type="application/json")
+            _set_meta(overlayKey=overlay_key)
         if det_mp4:
             det_key = f"{base_prefix}/detect_annotated.mp4"
             _upload(s3, bucket_exports, det_key, det_mp4, content_type="video/mp4")
@@ -593,8 +825,21 @@ def run_auto_edit(
         analysis_video = src
         # 2) CLAHE（需要 JSON）
         final_local: Optional[Path] = None
+        clahe_key = None
         if det_json:
-            clahe_mp4 = _run_clahe(src, det_json, tdir, effect_name="WB_CLAHE_JSON_ROI")
+            clahe_key = _artifact_key(store, "clahe", source_id, {
+                "effect": "WB_CLAHE_JSON_ROI",
+                "detections": artifacts.file_digest(det_npz or det_json),
+                "code": artifacts.code_digest([CLAHE_PY_PATH, *(Path(CLAHE_PY_PATH).with_name(m)
+                                                                 for m in ("videoio.py", "detarrays.py"))]),
+            }) if ENABLE_CLAHE else None
+            hit = store.fetch(clahe_key, tdir / "tools") if clahe_key else None
+            if hit:
+                clahe_mp4 = tdir / "tools" / "WB_CLAHE_JSON_ROI.mp4"
+            else:
+                clahe_mp4 = _run_clahe(src, det_npz or det_json, tdir, effect_name="WB_CLAHE_JSON_ROI")
+                if clahe_key and clahe_mp4 and clahe_mp4.exists():
+                    store.store(clahe_key, {clahe_mp4.name: clahe_mp4})
             if clahe_mp4 and clahe_mp4.exists():
                 final_local = clahe_mp4
                 analysis_video = clahe_mp4
@@ -604,7 +849,21 @@ def run_auto_edit(
 
         # 3) firmRoot（需要 JSON；優先當作最終輸出）
         if det_json:
-            fr_out, fr_high_dir, fr_logs_dir = _run_firmroot_pipeline(src, det_json, tdir, model_path="/models/firmRoot/best.pt", proc_video_override=analysis_video)
+            fr_model = "/models/firmRoot/best.pt"
+            fr_key = _artifact_key(store, "firmroot", source_id, {
+                "detections": artifacts.file_digest(det_json),
+                "proc": clahe_key if analysis_video != src else "source",
+                "model": artifacts.file_digest(fr_model) if Path(fr_model).exists() else None,
+                "code": artifacts.code_digest([FIRMROOT_DIR]),
+            }) if (analysis_video == src or clahe_key) else None  # 分析影片要有可重現的來源才快取
+            fr_root = tdir / "firmRoot_out"
+            if fr_key and store.fetch(fr_key, fr_root):
+                fr_out, fr_high_dir, fr_logs_dir = (p if p.exists() else None for p in (
+                    fr_root / "lam_output.mp4", fr_root / "highlights", fr_root / "logs"))
+            else:
+                fr_out, fr_high_dir, fr_logs_dir = _run_firmroot_pipeline(src, det_json, tdir, model_path=fr_model, proc_video_override=analysis_video)
+                if fr_key and fr_out and fr_out.exists():
+                    store.store(fr_key, {p.relative_to(fr_root).as_posix(): p for p in fr_root.rglob("*") if p.is_file()})
             if fr_out and fr_out.exists():
                 final_local = fr_out
                 _log("[pipeline] use firmRoot OUTPUT_VIDEO as final output")
@@ -678,5 +937,5 @@ def run_auto_edit(
         _upload(s3, bucket_exports, out_key, final_local, content_type="video/mp4")
 
         _set_meta(outputKey=out_key)
-        return {"ok": True, "outputKey": out_key, "jsonKey": json_key, "detectMp4Key": det_key}
+        return {"ok": True, "outputKey": out_key, "jsonKey": json_key, "detectMp4Key": det_key, "overlayKey": overlay_key}
 
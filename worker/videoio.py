@@ -0,0 +1,192 @@
+# worker/videoio.py
+# 共用影片解碼：ffmpeg rawvideo pipe，介面與 cv2.VideoCapture 相容（read/get/isOpened/release）
+import os, json, subprocess, threading
+from collections import deque
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+
+FFMPEG_BIN  = os.getenv("FFMPEG_BIN", "ffmpeg")
+FFPROBE_BIN = os.getenv("FFPROBE_BIN", "ffprobe")
+VIDEO_DECODER = os.getenv("VIDEO_DECODER", "auto")  # auto | cv2 | ffmpeg
+
+_CHANNELS = {"bgr24": 3, "rgb24": 3, "gray": 1}
+
+def _parse_rate(s: str) -> float:
+    try:
+        num, _, den = (s or "0/1").partition("/")
+        return float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError):
+        return 0.0
+
+def probe(path: str) -> dict:
+    """回傳第一個視訊串流的 width/height（轉正後）/fps/frames（frames 不一定準，0 表示未知）"""
+    rc = subprocess.run(
+        [FFPROBE_BIN, "-v", "error", "-select_streams", "v:0",
+         "-show_entries", "stream=width,height,avg_frame_rate,r_frame_rate,nb_frames:stream_tags=rotate"
+                          ":stream_side_data=rotation:format=duration",
+         "-of", "json", str(path)],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, check=False,
+    )
+    j = json.loads(rc.stdout or "{}")
+    streams = j.get("streams") or []
+    if not streams:
+        return {}
+    st = streams[0]
+    avg, base = _parse_rate(st.get("avg_frame_rate")), _parse_rate(st.get("r_frame_rate"))
+    fps = avg or base
+    frames = int(st.get("nb_frames") or 0)
+    if not frames and fps:
+        frames = int(round(float((j.get("format") or {}).get("duration") or 0) * fps))
+    cfr = bool(avg and base) and abs(avg - base) < 1e-3  # 固定幀率：第 n 格的時間就是 n / fps
+    # 手機直拍：ffmpeg 預設依旋轉資訊（舊版 rotate tag / display matrix side data）轉正，輸出的寬高要對調
+    rotation = (st.get("tags") or {}).get("rotate") or 0
+    for sd in st.get("side_data_list") or []:
+        rotation = sd.get("rotation", rotation)
+    w, h = int(st.get("width") or 0), int(st.get("height") or 0)
+    if int(float(rotation)) % 180:
+        w, h = h, w
+    return {"width": w, "height": h, "fps": fps, "frames": frames, "cfr": cfr}
+
+class FFmpegReader:
+    """
+    以 ffmpeg 解碼成 rawvideo 從 stdout 讀取。
+    - size=(w, h)：在 ffmpeg 內縮放（取代 Python 端的 cv2.resize）
+    - pix_fmt：bgr24（同 OpenCV）/ rgb24 / gray
+    - reuse_buffer=True：每格寫進同一塊 numpy buffer；呼叫端須在下一次 read() 前用完或自行 copy
+    """
+
+    def __init__(self, path: str, size: Optional[Tuple[int, int]] = None, pix_fmt: str = "bgr24",
+                 reuse_buffer: bool = False, threads: int = 0, interpolation: str = "area"):
+        self.path = str(path)
+        self.pix_fmt = pix_fmt
+        self.reuse_buffer = reuse_buffer
+        self.pos = 0
+        self._proc: Optional[subprocess.Popen] = None
+        self._buf: Optional[np.ndarray] = None
+
+        info = probe(self.path)
+        self.src_width, self.src_height = info.get("width", 0), info.get("height", 0)
+        self.fps = info.get("fps", 0.0)
+        self.frames = info.get("frames", 0)
+        self.exact_seek = info.get("cfr", False)  # set(CAP_PROP_POS_FRAMES) 落在精確的那一格（只有固定幀率做得到）
+        if not (self.src_width and self.src_height):
+            return  # isOpened() == False
+
+        self.width, self.height = size or (self.src_width, self.src_height)
+        c = _CHANNELS[pix_fmt]
+        self.shape = (self.height, self.width, c) if c > 1 else (self.height, self.width)
+        self.frame_bytes = self.width * self.height * c
+
+        self._input = ["-threads", str(threads)] if threads else []
+        self._output = ["-map", "0:v:0", "-an", "-sn"]
+        if size:
+            self._output += ["-vf", f"scale={self.width}:{self.height}", "-sws_flags", interpolation]
+        self._output += ["-f", "rawvideo", "-pix_fmt", pix_fmt, "-vsync", "passthrough", "pipe:1"]
+        self._start(0)
+
+    def _start(self, frame: int):
+        # -ss 放在 -i 前：從前一個關鍵格解碼、丟掉目標時間之前的格（ffmpeg 預設 accurate_seek），不用逐格讀過 pipe。
+        # 目標取第 frame 格與前一格的中點：n / fps 四捨五入後可能比該格真正的 pts 晚一點點，那一格就會被丟掉
+        seek = ["-ss", f"{(frame - 0.5) / self.fps:.6f}"] if frame and self.fps else []
+        cmd = [FFMPEG_BIN, "-hide_banner", "-loglevel", "error", "-nostdin", *self._input, *seek, "-i", self.path,
+               *self._output]
+        self._proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                      bufsize=self.frame_bytes * 2)
+        self.pos = frame if seek else 0
+        # stderr 由背景執行緒讀掉（不然 pipe 滿了 ffmpeg 會卡住），只留最後幾行，解碼失敗時附在例外訊息裡
+        self._stderr = deque(maxlen=20)
+        self._drainer = threading.Thread(target=self._drain, args=(self._proc.stderr, self._stderr), daemon=True)
+        self._drainer.start()
+
+    @staticmethod
+    def _drain(pipe, tail: deque):
+        for line in iter(pipe.readline, b""):
+            tail.append(line.decode(errors="replace").rstrip())
+        pipe.close()
+
+    def isOpened(self) -> bool:
+        return self._proc is not None
+
+    def _next_buffer(self) -> np.ndarray:
+        if self.reuse_buffer:
+            if self._buf is None:
+                self._buf = np.empty(self.shape, dtype=np.uint8)
+            return self._buf
+        return np.empty(self.shape, dtype=np.uint8)
+
+    def read(self):
+        if self._proc is None:
+            return False, None
+        buf = self._next_buffer()
+        view = memoryview(buf.reshape(-1))
+        got = 0
+        while got < self.frame_bytes:  # pipe 可能一次給不滿一格
+            n = self._proc.stdout.readinto(view[got:])
+            if not n:
+                self._finish()
+                return False, None
+            got += n
+        self.pos += 1
+        return True, buf
+
+    def _finish(self):
+        # 讀到結尾：ffmpeg 正常結束回傳 0；非 0 表示解碼中途失敗，不能當成影片結束
+        try:
+            rc = self._proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            rc = None
+        self.release()
+        if rc:
+            self._drainer.join(timeout=1)
+            err = "\n".join(self._stderr) or "no stderr"
+            raise RuntimeError(f"ffmpeg exited with {rc} decoding {self.path} at frame {self.pos}:\n{err}")
+
+    def grab(self) -> bool:
+        return self.read()[0]
+
+    def get(self, prop: int) -> float:
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(getattr(self, "width", 0))
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(getattr(self, "height", 0))
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return float(self.frames)
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return float(self.pos)
+        return 0.0
+
+    def set(self, prop: int, value: float) -> bool:
+        """只支援 CAP_PROP_POS_FRAMES 且影片為固定幀率（exact_seek）：以 -ss 重新啟動 ffmpeg；其他回傳 False"""
+        if prop != cv2.CAP_PROP_POS_FRAMES or not self.exact_seek or not getattr(self, "frame_bytes", 0):
+            return False
+        self.release()
+        self._start(max(int(value), 0))
+        return True
+
+    def release(self):
+        p, self._proc = self._proc, None
+        if p is None:
+            return
+        try:
+            if p.stdout:
+                p.stdout.close()
+            p.terminate()
+            p.wait(timeout=5)
+        except Exception:
+            p.kill()
+
+    def __del__(self):
+        self.release()
+
+def open_video(path: str, decoder: str = VIDEO_DECODER, **kwargs):
+    """auto：先試 cv2.VideoCapture，打不開再改用 ffmpeg；cv2 / ffmpeg：強制指定"""
+    if decoder != "ffmpeg":
+        cap = cv2.VideoCapture(str(path))
+        if cap.isOpened() or decoder == "cv2":
+            return cap
+        cap.release()
+    return FFmpegReader(path, **kwargs)
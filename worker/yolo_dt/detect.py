@@ -1,23 +1,51 @@
 import argparse
+import sys
 import time
+from functools import partial
 from pathlib import Path
 
 import cv2
 import torch
 import torch.backends.cudnn as cudnn
+import numpy as np
 from numpy import random
 
-from models.experimental import attempt_load
-from utils.datasets import LoadStreams, LoadImages
-from utils.general import check_img_size, check_requirements, check_imshow, non_max_suppression, apply_classifier, \
-    scale_coords, xyxy2xywh, strip_optimizer, set_logging, increment_path
+from models.backends import exec_mode, load_model
+from models.experimental import Ensemble
+from utils.datasets import LoadStreams, LoadImages, PrefetchLoader, batch_frames, letterbox, open_video
+from utils.general import check_img_size, check_requirements, check_imshow, non_max_suppression, batched_nms, \
+    apply_classifier, scale_coords, xyxy2xywh, strip_optimizer, set_logging, increment_path
 from utils.plots import plot_one_box
+from utils.temporal import MotionGate, StrideInterpolator
+from utils.roi import PitchROI
+from utils.refine import BallRefiner
+from utils.shards import run_shards
+from utils.tiles import parse_tiles, tile_grid, untile
+from utils.writers import JsonlWriter, TextSink, VideoRenderer, iter_jsonl, jsonl_to_json
+from detarrays import Detections  # worker/detarrays.py
 from utils.torch_utils import select_device, load_classifier, time_synchronized, TracedModel
 
 from tqdm import tqdm
-import json
 
-def detect(save_img=False):
+def check_raw(model, weights):
+    # detect.py needs raw predictions: an End2End export ranks and thresholds the ball by its real score inside
+    # the graph, while non_max_suppression() forces it to 1.0, so its JSON would not match the torch backend
+    assert not getattr(model, 'end2end', False), \
+        f'{weights}: End2End export (NMS in the graph), export it without --end2end'
+
+
+def load_detect_model(opt, device):
+    # Model for detect(); a long-lived caller (worker/detector.py) loads it once and passes it to every run
+    model = load_model(opt.weights, opt.backend, device, threads=opt.ort_threads, img_size=opt.img_size,
+                       cache_dir=opt.model_cache, trace=opt.cache_traced)  # load FP32 model / ORT session
+    check_raw(model, opt.weights)
+    return exec_mode(model, opt.exec_mode, device, opt.img_size, opt.model_cache) if opt.backend == 'torch' else model
+
+
+def detect(opt, model=None, progress=None):
+    # progress(frame, total): called after every written frame, total is None for streams/images; an exception
+    # raised by it (e.g. a cancel request) stops the run after the open files are closed
+    # Returns the output paths: {'dir', 'video', 'json', 'npz'}
     source, weights, save_txt, imgsz, trace = opt.source, opt.weights, opt.save_txt, opt.img_size, not opt.no_trace
     save_img = not opt.nosave and not source.endswith('.txt')  # save inference images
     webcam = source.isnumeric() or source.endswith('.txt') or source.lower().startswith(
@@ -26,12 +54,13 @@ def detect(save_img=False):
     input_video = source.endswith('.mp4') or source.endswith('.avi') or source.endswith('.mkv')
     
     #!check the video
-    cap = cv2.VideoCapture(source)
+    cap = open_video(source, opt.decoder)  # cv2, or ffmpeg rawvideo pipe when cv2 cannot open it
 
     if not cap.isOpened():
         print("Cannot open the video")
     else:
-        print("----影片可以成功讀取-------")
+        print(f"----影片可以成功讀取({type(cap).__name__})-------")
+    cap.release()
    
     
     
@@ -41,12 +70,18 @@ def detect(save_img=False):
 
     (save_dir / 'image' if save_txt else save_dir).mkdir(parents=True, exist_ok=True)
 
+    if opt.threads:
+        torch.set_num_threads(opt.threads)
+    if opt.shards > 1 and opt.frame_range is None and not webcam:  # K detect.py processes over time ranges
+        return run_shards(opt, save_dir, progress)
+
     device = select_device(opt.device)
-    half = device.type != 'cpu'  # half 
+    half = device.type != 'cpu' and opt.backend == 'torch'  # half 
     # precision only supported on CUDA
     
     # Load model
-    model = attempt_load(weights, map_location=device)  # load FP32 model
+    if model is None:
+        model = load_detect_model(opt, device)
     #checking the model
     #print(f'checking the model{model}')
     
@@ -56,6 +91,9 @@ def detect(save_img=False):
     
     stride = int(model.stride.max())  # model stride
     imgsz = check_img_size(imgsz, s=stride)  # check img_size
+    static = getattr(model, 'img_size', None)  # exported ONNX input (h, w): pad every frame to exactly that
+    if static:
+        imgsz = static
     
     if half:                      #把模型的精度降為一半 float32 -> float16 更快 省mem
         model.half()  # to FP16
@@ -67,18 +105,43 @@ def detect(save_img=False):
         dataset = LoadStreams(source, img_size=imgsz, stride=stride)
     else:
         #check if the load works
-        dataset = LoadImages(source, img_size=imgsz, stride=stride)
+        dataset = LoadImages(source, img_size=imgsz, stride=stride, decoder=opt.decoder, auto=not static)
     
     
     # Get names and colors
     names = model.module.names if hasattr(model, 'module') else model.names  #取得所有label的名稱
     colors = [[random.randint(0, 255) for _ in range(3)] for _ in names]     #label框對應的顏色
+
+    # Several --weights: members run in parallel threads, each at its own input size / on its own classes
+    if isinstance(model, Ensemble):
+        member_classes = [None if c in ('all', '*') else [list(names).index(k) if k in names else int(k)
+                                                          for k in c.split(',')] for c in opt.ensemble_classes or ()]
+        model.configure(opt.ensemble_img_size, member_classes, opt.ensemble_threads)
+
+    # Pitch ROI: infer on the polygon's bounding crop only, drop boxes whose bottom-center is off the pitch
+    roi = None
+    if opt.roi_profile and not webcam:
+        if dataset.cap is not None:
+            shape = (int(dataset.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(dataset.cap.get(cv2.CAP_PROP_FRAME_WIDTH)))
+        else:
+            shape = cv2.imread(dataset.files[0]).shape[:2]
+        roi = PitchROI.load(opt.roi_profile, shape, names=list(names))
+        dataset.crop = roi.crop
+        print(f'{opt.roi_profile}: {roi}')
+
+    # Tiled inference: every frame becomes rows x cols overlapping tiles in one batch, merged by one NMS
+    tiles = parse_tiles(opt.tiles) if opt.tiles and not webcam else None
+    if tiles:
+        dataset.tiles = (*tiles, opt.tile_overlap)
  
     if opt.write_log:
         with open('%s.txt' % opt.write_log, 'a') as f:
             f.write('Frame Person Ball Ball_Pos\n')
             
-    results = {}
+    # Per-frame results are streamed to <source>.jsonl and converted to the legacy json layout at the end
+    results = JsonlWriter(save_dir / (Path(source).stem + '.jsonl'), buffer=opt.json_buffer) \
+        if opt.save_json or opt.save_npz else None
+    labels = TextSink()  # buffered --save-txt label files
     
     
     if input_video:
@@ -86,159 +149,372 @@ def detect(save_img=False):
             vid_len = int(vid_cap.get(cv2.CAP_PROP_FRAME_COUNT))
             pbar = tqdm(total=int(vid_len))
             break
-    
-    for idx, (path, img, im0s, vid_cap) in enumerate(dataset):   #im0s為原圖, img為近模型的size
-        print(f'processing frame {idx}.....')
-        #im0 = cv2.resize(im0s, (854, 480))
-        img = torch.from_numpy(img).to(device)
-        img = img.half() if half else img.float()  # uint8 to fp16/32
-        img /= 255.0  # 0 - 255 to 0.0 - 1.0
-        if img.ndimension() == 3:
-            img = img.unsqueeze(0)  #進模型前多一個維度 batch_size
-               
-       
-        # Inference
-        t1 = time_synchronized()
-        pred = model(img, augment=opt.augment)[0]
-        #check the pred
-        #print(f'check pred value:{pred}')
-        
-        
-        t2 = time_synchronized()
-        # Apply NMS
-        pred = non_max_suppression(pred, opt.conf_thres, opt.iou_thres, classes=opt.classes, agnostic=opt.agnostic_nms)
-        #!check
-        #print(f'the pred after non_max_surpression : {pred}')
-        t3 = time_synchronized()
 
-        #print(f'{opt.classes=}, {opt.augment=}')
+    # Frame stride: run the detector only on keyframes and interpolate the other frames per class
+    interp = StrideInterpolator(opt.frame_stride, len(names)) if not webcam and opt.frame_stride > 1 else None
+    save_path = ''
 
-        # Process detections
+    # Shard of a sharded run: frames [lo, hi) keep their absolute numbers. The range is widened by one stride on
+    # both sides so interpolated frames near the edges see the same keyframes as an unsharded run
+    lo, hi = opt.frame_range or (0, -1)
+    pad = opt.frame_stride - 1 if interp is not None else 0
+    idx = 0
+    if opt.frame_range:
+        idx = max(lo - pad, 0)
+        dataset.set_range(idx, hi + pad - idx if hi >= 0 else None)
+
+    # Motion gate: frames that barely changed since the last inferred frame reuse its detections
+    gate = MotionGate(opt.motion_thres, opt.motion_area, opt.motion_max_skip, region=dataset.crop) \
+        if opt.motion_gate and not webcam else None
+    last = torch.zeros((0, 6))  # detections of the last inferred frame
+    reused = set()  # frame numbers whose detections were reused
+
+    # NMS: the whole batch in one batched_nms call; --class-conf name=thres (or index=thres) implies it
+    class_conf = {(list(names).index(c) if c in names else int(c)): float(v)
+                  for c, v in (a.split('=') for a in opt.class_conf or ())}
+    nms = partial(batched_nms, class_conf=class_conf) if opt.batched_nms or class_conf else non_max_suppression
+
+    # Coarse-to-fine ball: the --img-size pass finds the players, the ball comes from a high-resolution window
+    # around its predicted position (whole frame at --ball-full-size when it is lost)
+    ball_cls = list(names).index('ball') if 'ball' in names else 1
+
+    def infer_images(ims, size, classes=None, m=None, region=None):
+        # Extra batched pass on same-size images (ball window, cascade) -> (k, 6) detections per image in image
+        # pixels; region crops every image first and its offset is added back
+        m = model if m is None else m
+        fixed = getattr(m, 'img_size', None)  # static-shape ONNX input
+        if region is not None:
+            ims = [im[region[1]:region[3], region[0]:region[2]] for im in ims]
+        x = np.stack([letterbox(im, fixed or size, stride=stride, auto=not fixed)[0] for im in ims], 0)
+        x = torch.from_numpy(np.ascontiguousarray(x[..., ::-1].transpose(0, 3, 1, 2))).to(device)
+        x = (x.half() if half else x.float()) / 255.0
+        pred = m(x, augment=opt.augment)[0]
+        dets = nms(pred, opt.conf_thres, opt.iou_thres, classes=classes)
+        for d, im in zip(dets, ims):
+            d[:, :4] = scale_coords(x.shape[2:], d[:, :4], im.shape).round()
+            if region is not None:
+                d[:, :4] += torch.tensor(region[:2] * 2, dtype=d.dtype, device=d.device)
+        return dets
+
+    def check_size(m, size, opt_name):
+        # A static-shape ONNX model only runs at its export size; a pass asking for another size would silently run
+        # at the base resolution instead
+        fixed = getattr(m, 'img_size', None)
+        assert not fixed or max(fixed) == size, f'{opt_name} {size}: the model is exported at a fixed {fixed}, ' \
+                                                f'export one at {size} or run the torch backend'
+
+    refiner = None
+    if opt.ball_refine and not webcam:
+        check_size(model, opt.ball_img_size, '--ball-img-size')
+        check_size(model, opt.ball_full_size, '--ball-full-size')
+        refiner = BallRefiner(lambda im, size: infer_images([im], size, classes=[ball_cls])[0], ball_cls,
+                              opt.ball_window, opt.ball_img_size, opt.ball_full_size)
+
+    # Resolution cascade: frames without a ball scoring cascade_conf at --img-size are re-run at cascade_img_size
+    cascade = None
+    if opt.cascade_img_size and not webcam:
+        cascade = load_model(opt.cascade_weights, opt.backend, device, threads=opt.ort_threads,
+                             img_size=opt.cascade_img_size, cache_dir=opt.model_cache) if opt.cascade_weights else model
+        if half and cascade is not model:
+            cascade.half()
+        check_raw(cascade, opt.cascade_weights)
+        check_size(cascade, opt.cascade_img_size, '--cascade-img-size (or --cascade-weights)')
+    n_checked = n_escalated = 0
+    hires = {}  # frame -> high-resolution detections of escalated frames
+
+    prefetch = opt.prefetch > 0 and not webcam
+    if prefetch:  # decode + letterbox the next frames while the model runs
+        dataset = PrefetchLoader(dataset, depth=opt.prefetch)
+
+    def process(n, det, p, s, im0, frame, vcap, mode):
+        # Write results / annotate one image. det: (k,6) [xyxy, conf, cls] in im0 coordinates, optionally a 7th
+        # column flagging interpolated boxes
+        nonlocal vid_path, vid_writer, save_path
+        reuse = n in reused
+        reused.discard(n)
+        if n < lo or 0 <= hi <= n:  # shard padding
+            return
+        if not webcam:
+            print(f'processing frame {n}.....')
         person_count = 0
         ball_count = 0
         ball_pos = []
-        
-        #print(f'{pred=}')
-
         save_result = {}
-        for i, det in enumerate(pred):  # detections per image
-            if webcam:  # batch_size >= 1
-                p, s, im0, frame = path[i], '%g: ' % i, im0s[i].copy(), dataset.count
-            else:
-                p, s, im0, frame = path, '', im0s, getattr(dataset, 'frame', 0)
+        drawn = []  # (xyxy, conf, cls) to draw on the saved image / video
 
-            p = Path(p)  # to Path
-            save_path = str(save_dir / p.name)  # img.jpg
-            txt_path = str(save_dir / 'labels' / p.stem) + ('' if dataset.mode == 'image' else f'_{frame}')  # img.txt
+        p = Path(p)  # to Path
+        save_path = str(save_dir / p.name)  # img.jpg
+        txt_path = str(save_dir / 'labels' / p.stem) + ('' if mode == 'image' else f'_{frame}')  # img.txt
 
-            img_path = str(save_dir / 'image' / p.stem) + ('' if dataset.mode == 'image' else f'_{frame}')
-            
-            gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]  # normalization gain whwh
-            if len(det):
-                # Rescale boxes from img_size to im0 size
-                det[:, :4] = scale_coords(img.shape[2:], det[:, :4], im0.shape).round()
-                # print("check1")
-                #print(f'{det=}')
-                # exit()
-
-                # Print results
-                # for c in det[:, -1].unique():
-                #     n = (det[:, -1] == c).sum()  # detections per class
-                #     s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
-                    
+        img_path = str(save_dir / 'image' / p.stem) + ('' if mode == 'image' else f'_{frame}')
+        
+        gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]  # normalization gain whwh
+        if len(det):
+            # Print results
+            # for c in det[:, -1].unique():
+            #     n = (det[:, -1] == c).sum()  # detections per class
+            #     s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
                 
-                # Write results
-                for *xyxy, conf, cls in reversed(det):
-                    if save_txt:  # Write to file
-                        xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
-                        line = (cls, *xywh, conf) if opt.save_conf else (cls, *xywh)  # label format
-                        #print(f'{gn=}{xywh=}, {line=}, {cls=}')
-                        # print("check")
-                        # cv2.imwrite('./testframe.jpg', im0)
-                        # exit()
-                        if(cls == 1):# write ball label
-                            # ball_pos.append(('%g ' * len(line)).rstrip() % line)
-                            ball_pos.append([[int(xyxy[0]), int(xyxy[1])], [int(xyxy[2]), int(xyxy[3])], conf.item()])
-                        name = names[int(cls)]
-                        if not name in save_result:
-                            save_result[name] = []
-
-                        save_result[name].append([[int(xyxy[0]), int(xyxy[1])], [int(xyxy[2]), int(xyxy[3])], conf.item()])
-                        
-                        
-                        with open(txt_path + '.txt', 'a') as f:
-                            f.write(('%g ' * len(line)).rstrip() % line + '\n')
-                            # cv2.imwrite(img_path + '.jpg', im0)
-
-                    if save_img:  # Add bbox to image
-                        label = f'{names[int(cls)]} {conf:.2f}'
-                        plot_one_box(xyxy, im0, label=label, color=colors[int(cls)], line_thickness=2)
-                        if('person' in label):
-                            person_count += 1
-                        elif('ball' in label):
-                            ball_count += 1 
-                        # if(int(cls) == 1):
-                        #     plot_one_box(xyxy, im0, label=label, color=(255, 0, 0), line_thickness=1)
-                        #####################################################
-                        # if('person' in label):
-                        #     continue
-                        # else:
-                        #     plot_one_box(xyxy, im0, label=label, color=colors[int(cls)], line_thickness=1)
-                        #####################################################
-                        
-            results[str(idx)] = save_result
-            
-            # print(f'{s}Done. ({(1E3 * (t2 - t1)):.1f}ms) Inference, ({(1E3 * (t3 - t2)):.1f}ms) NMS')
+            # Convert the whole frame at once (reversed = ascending conf, the order boxes were always written in)
+            det = det.flip(0).cpu()
+            xyxy_all = det[:, :4].tolist()
+            confs = det[:, 4].tolist()
+            clss = det[:, 5].int().tolist()
             
-            # Save results (image with detections)
-            if save_img:
-                if dataset.mode == 'image':
-                    cv2.imwrite(save_path, im0)
-                    #print(f" The image with the result is saved in: {save_path}")
-                else:  # 'video' or 'stream'
-                    if vid_path != save_path:  # new video
-                        vid_path = save_path
-                        if isinstance(vid_writer, cv2.VideoWriter):
-                            vid_writer.release()  # release previous video writer
-                        if vid_cap:  # video
-                            fps = vid_cap.get(cv2.CAP_PROP_FPS)
-                            w = int(vid_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-                            h = int(vid_cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-                        else:  # stream
-                            fps, w, h = 30, im0.shape[1], im0.shape[0]
-                            save_path += '.mp4'
-                        vid_writer = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
-                        #vid_writer = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'),  fps, (854, 480))
-                    
+            # Write results
+            if save_txt:  # Write to file
+                flags = det[:, 6].tolist() if det.shape[1] > 6 else [0] * len(det)  # 1 = interpolated
+                xyxy_int = det[:, :4].int().tolist()
+                xywhn = xyxy2xywh(det[:, :4]) / gn  # normalized xywh
+                lines = torch.cat((det[:, 5:6], xywhn, det[:, 4:5]) if opt.save_conf else (det[:, 5:6], xywhn), 1)  # label format
+                for (x1, y1, x2, y2), conf, c, flag in zip(xyxy_int, confs, clss, flags):
+                    box = [[x1, y1], [x2, y2], conf]
+                    if flag:  # interpolated between keyframes (legacy readers use item[:3])
+                        box.append('interp')
+                    elif reuse:  # motion gate: copied from the last inferred frame
+                        box.append('reused')
+                    if(c == 1):# write ball label
+                        ball_pos.append(box)
+                    save_result.setdefault(names[c], []).append(box)
+                for line in lines.tolist():
+                    labels.write(txt_path + '.txt', ' '.join('%g' % v for v in line))
+                    # cv2.imwrite(img_path + '.jpg', im0)
 
-                    vid_writer.write(im0)
+            if save_img:  # Add bbox to image (drawn by the video renderer thread, inline for images)
+                drawn = list(zip(xyxy_all, confs, clss))
+                for c in clss:
+                    if('person' in names[c]):
+                        person_count += 1
+                    elif('ball' in names[c]):
+                        ball_count += 1 
+                    # if(int(cls) == 1):
+                    #     plot_one_box(xyxy, im0, label=label, color=(255, 0, 0), line_thickness=1)
+                    #####################################################
+                    # if('person' in label):
+                    #     continue
+                    # else:
+                    #     plot_one_box(xyxy, im0, label=label, color=colors[int(cls)], line_thickness=1)
+                    #####################################################
                     
-            if opt.write_log:
-                with open('%s.txt' % opt.write_log, 'a') as f:
-                    f.write('%d %d %d %s\n' % (int(frame), person_count, ball_count, str(ball_pos)))
+        if results is not None:
+            results.write(n, save_result)
+        
+        # Save results (image with detections)
+        if save_img:
+            if mode == 'image':
+                for xyxy, conf, c in drawn:
+                    plot_one_box(xyxy, im0, label=f'{names[c]} {conf:.2f}', color=colors[c], line_thickness=2)
+                cv2.imwrite(save_path, im0)
+                #print(f" The image with the result is saved in: {save_path}")
+            else:  # 'video' or 'stream'
+                if vid_path != save_path:  # new video
+                    vid_path = save_path
+                    if vid_writer is not None:
+                        vid_writer.close()  # finish previous video
+                        print(vid_writer.summary())
+                    if vcap:  # video
+                        fps = vcap.get(cv2.CAP_PROP_FPS)
+                        w = int(vcap.get(cv2.CAP_PROP_FRAME_WIDTH))
+                        h = int(vcap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+                    else:  # stream
+                        fps, w, h = 30, im0.shape[1], im0.shape[0]
+                        save_path += '.mp4'
+                    vid_writer = VideoRenderer(save_path, fps, (w, h), plot_one_box, names, colors,
+                                               depth=opt.render_queue, scale=opt.render_scale)
+                    #vid_writer = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'),  fps, (854, 480))
+                
+
+                vid_writer.write(im0, drawn)
+                
+        if opt.write_log:
+            with open('%s.txt' % opt.write_log, 'a') as f:
+                f.write('%d %d %d %s\n' % (int(frame), person_count, ball_count, str(ball_pos)))
 
         if input_video:
             pbar.update(1)
+        if progress is not None:
+            progress(n, vid_len if input_video else None)
+
+    try:
+        for batch in batch_frames(dataset, 1 if webcam else opt.batch_size):   #im0s為原圖, img為近模型的size
+            path, img, im0s, vid_cap, frames = zip(*batch)
+            if webcam:  # one entry holding every stream, img is already batched
+                img = img[0]
+                entries = [(idx, path[0][i], '%g: ' % i, im0s[0][i].copy(), dataset.count, None, dataset.mode)
+                           for i in range(len(img))]
+                due = [True] * len(entries)
+            else:  # one video frame / image per batch entry
+                entries = [(idx + i, path[i], '', im0s[i], frames[i], vid_cap[i], dataset.mode) for i in range(len(batch))]
+                due = [interp is None or interp.due(idx + i) for i in range(len(batch))]
+                if gate is not None:  # due but static: reuse the previous detections instead of inferring
+                    due = [d and (gate.check(im0s[i]) or 'reuse') for i, d in enumerate(due)]
+                run = [d is True for d in due]
+                img = np.stack([x for x, r in zip(img, run) if r], 0) if any(run) else None
+            idx += 1 if webcam else len(batch)
+
+            pred = []
+            if img is not None:
+                img = torch.from_numpy(img).to(device)
+                img = img.half() if half else img.float()  # uint8 to fp16/32
+                img /= 255.0  # 0 - 255 to 0.0 - 1.0
+                if img.ndimension() == 3:
+                    img = img.unsqueeze(0)  #進模型前多一個維度 batch_size
+                nt = img.shape[1] if img.ndimension() == 5 else 0  # tiles per frame
+                if nt:
+                    img = img.flatten(0, 1)
+               
+       
+                # Inference
+                t1 = time_synchronized()
+                pred = model(img, augment=opt.augment)[0]
+                #check the pred
+                #print(f'check pred value:{pred}')
+        
+        
+                t2 = time_synchronized()
+                if nt:  # tile predictions -> frame coordinates, all tiles of a frame into one NMS
+                    grid = tile_grid(*entries[0][3].shape[:2], *dataset.tiles, region=dataset.crop)  # same grid LoadImages cut
+                    pred = untile(pred.view(-1, nt, *pred.shape[1:]), grid, img.shape[2:])
+                # Apply NMS
+                escalate = ((pred[..., 4] * pred[..., 5 + ball_cls]).amax(1) < opt.cascade_conf).tolist() \
+                    if cascade is not None else []  # best ball score per frame, before NMS forces it to 1
+                pred = nms(pred, opt.conf_thres, opt.iou_thres, classes=opt.classes, agnostic=opt.agnostic_nms)
+                #!check
+                #print(f'the pred after non_max_surpression : {pred}')
+                t3 = time_synchronized()
+                # print(f'{s}Done. ({(1E3 * (t2 - t1)):.1f}ms) Inference, ({(1E3 * (t3 - t2)):.1f}ms) NMS')
+
+                if cascade is not None:  # one high-resolution batch for the frames without a ball
+                    esc = [e for e, low in zip([e for e, d in zip(entries, due) if d is True], escalate) if low]
+                    if esc:
+                        hi_dets = infer_images([e[3] for e in esc], opt.cascade_img_size, m=cascade,
+                                               region=dataset.crop)
+                        hires.update((e[0], d) for e, d in zip(esc, hi_dets))
+                    n_checked += len(escalate)
+                    n_escalated += len(esc)
+
+            #print(f'{opt.classes=}, {opt.augment=}')
+
+            # Process detections
+            pred = iter(pred)
+            for entry, d in zip(entries, due):  # detections per image
+                det = next(pred) if d is True else None
+                if det is not None and len(det):
+                    # Rescale boxes from img_size to im0 size
+                    if tiles:  # already in frame coordinates
+                        det[:, :4] = det[:, :4].round()
+                        if roi is not None:
+                            det = det[torch.from_numpy(roi.keep(det)).to(det.device)]
+                    elif roi is None:
+                        det[:, :4] = scale_coords(img.shape[2:], det[:, :4], entry[3].shape).round()
+                    else:  # crop coordinates -> frame, then off-pitch boxes out
+                        det[:, :4] = scale_coords(img.shape[2:], det[:, :4], roi.shape).round()
+                        det[:, :4] += torch.tensor(roi.offset, dtype=det.dtype, device=det.device)
+                        det = det[torch.from_numpy(roi.keep(det)).to(det.device)]
+                if d is True:
+                    if entry[0] in hires:  # escalated: ball boxes from the high-resolution pass
+                        balls = hires.pop(entry[0]).to(det.device)
+                        balls = balls[balls[:, 5] == ball_cls]
+                        if roi is not None:
+                            balls = balls[torch.from_numpy(roi.keep(balls)).to(det.device)]
+                        if len(balls):
+                            det = torch.cat((det[det[:, 5] != ball_cls], balls), 0)
+                            det = det[det[:, 4].argsort(descending=True, stable=True)]
+                    if refiner is not None:
+                        det = refiner(entry[0], det, entry[3])
+                        if roi is not None:
+                            det = det[torch.from_numpy(roi.keep(det)).to(det.device)]
+                    last = det
+                elif d == 'reuse':
+                    det = last.clone()
+                    reused.add(entry[0])
+                if interp is None:
+                    process(entry[0], det, *entry[1:])
+                else:
+                    for det, entry in interp.push(entry[0], None if det is None else det.cpu(), entry):
+                        process(entry[0], det, *entry[1:])
+
+        if interp is not None:  # frames after the last keyframe
+            for det, entry in interp.flush():
+                process(entry[0], det, *entry[1:])
             
-    if input_video:
-        pbar.close()
+    finally:  # also on cancel / errors: stop the decoder thread and finalize the open files
+        if input_video:
+            pbar.close()
+        if prefetch:
+            dataset.close()
+            print(f'prefetch: queue depth {opt.prefetch}, inference stalled {dataset.stall:.1f}s waiting for frames')
+        cap = getattr(dataset, 'cap', None)
+        if cap is not None:
+            cap.release()
+        if vid_writer is not None:
+            vid_writer.close()
+            print(vid_writer.summary())
+        if results is not None:
+            results.close()
         
+    labels.flush()
+    out = {'dir': str(save_dir), 'video': save_path if save_img and save_path else None, 'json': None, 'npz': None}
+    if cascade is not None:
+        print(f'cascade: {n_escalated}/{n_checked} frames escalated to {opt.cascade_img_size} '
+              f'({100 * n_escalated / max(n_checked, 1):.1f}%)')
+        out['cascade_escalated'] = round(n_escalated / max(n_checked, 1), 4)
+    if refiner is not None:
+        print(refiner.summary())
+        out['ball_full_searches'] = refiner.full
+    if gate is not None:
+        print(gate.summary())
+        out['motion_skipped'] = round(gate.skipped / max(gate.checked, 1), 4)
     if opt.save_json:
-        with open(save_path[:-3] + 'json', "w") as outfile:
-            json.dump(results, outfile)
+        out['json'] = jsonl_to_json(results.path, save_path[:-3] + 'json')
+    if opt.save_npz:  # columnar frame_idx/cls/xyxy/conf arrays + per-frame offsets
+        out['npz'] = Detections.from_records(iter_jsonl(results.path), names=list(names)).save(save_path[:-3] + 'npz')
             
 #     if save_txt or save_img:
 #         s = f"\n{len(list(save_dir.glob('labels/*.txt')))} labels saved to {save_dir / 'labels'}" if save_txt else ''
 #         print(f"Results saved to {save_dir}{s}")
     
     # print(f'Done. ({time.time() - t0:.3f}s)')
-    
+    return out
 
-if __name__ == '__main__':
+
+
+def parse_opt(args=None):
+    # args: the detect.py command line as a list (None = sys.argv), shared by the CLI and worker/detector.py
     parser = argparse.ArgumentParser()
     parser.add_argument('--weights', nargs='+', type=str, default='yolov7.pt', help='model.pt path(s)')
     parser.add_argument('--source', type=str, default='inference/images', help='source')  # file/folder, 0 for webcam
     parser.add_argument('--img-size', type=int, default=640, help='inference size (pixels)')
+    parser.add_argument('--batch-size', type=int, default=1, help='video frames per forward pass')
+    parser.add_argument('--prefetch', type=int, default=0, help='frames decoded ahead in a background thread, 0 = off')
+    parser.add_argument('--frame-stride', type=int, default=1, help='run the detector every K-th frame, interpolate the rest')
+    parser.add_argument('--shards', type=int, default=1, help='split the video into K time ranges, one detect.py process each')
+    parser.add_argument('--shard-threads', type=int, default=0, help='torch threads per shard, 0 = cpu count / shards')
+    parser.add_argument('--shard-retries', type=int, default=1, help='re-runs of a failed shard')
+    parser.add_argument('--frame-range', nargs=2, type=int, default=None, help='internal (sharding): frames START END, END -1 = to the end')
+    parser.add_argument('--threads', type=int, default=0, help='torch intra-op threads, 0 = default')
+    parser.add_argument('--ensemble-img-size', nargs='+', type=int, default=None, help='per --weights member: inference size, 0 = --img-size')
+    parser.add_argument('--ensemble-classes', nargs='+', type=str, default=None, help='per --weights member: classes it contributes, e.g. person ball or 0 1,2; all = every class')
+    parser.add_argument('--ensemble-threads', type=int, default=0, help='intra-op threads per ensemble member, 0 = torch threads / members')
+    parser.add_argument('--batched-nms', action='store_true', help='one batched NMS call for the whole batch')
+    parser.add_argument('--class-conf', nargs='+', type=str, default=None, help='per-class conf on top of --conf-thres: ball=0.1 0=0.3 (implies --batched-nms)')
+    parser.add_argument('--cascade-img-size', type=int, default=0, help='re-run frames without a ball at this size, 0 = off')
+    parser.add_argument('--cascade-conf', type=float, default=0.25, help='cascade: ball score (obj * cls) that counts as found')
+    parser.add_argument('--cascade-weights', nargs='+', type=str, default=None, help='cascade: separate model for the high-resolution pass (e.g. an .onnx exported at that size)')
+    parser.add_argument('--ball-refine', action='store_true', help='coarse --img-size pass + high-resolution ball window')
+    parser.add_argument('--ball-window', type=int, default=480, help='ball window size in video pixels')
+    parser.add_argument('--ball-img-size', type=int, default=640, help='inference size of the ball window')
+    parser.add_argument('--ball-full-size', type=int, default=1280, help='inference size of the whole-frame search when the ball is lost')
+    parser.add_argument('--motion-gate', action='store_true', help='reuse the previous detections on frames without motion')
+    parser.add_argument('--motion-thres', type=float, default=12, help='motion gate: per-pixel gray level change that counts as motion')
+    parser.add_argument('--motion-area', type=float, default=0.002, help='motion gate: fraction of changed pixels that triggers inference')
+    parser.add_argument('--motion-max-skip', type=int, default=30, help='motion gate: force inference after this many reused frames')
+    parser.add_argument('--tiles', default='', help='tiled inference grid RxC, e.g. 2x2; --img-size is then the tile size')
+    parser.add_argument('--tile-overlap', type=float, default=0.15, help='fraction of a tile shared with its neighbour')
+    parser.add_argument('--roi-profile', default='', help='camera profile json with the pitch polygon (inference on its crop)')
+    parser.add_argument('--decoder', default='auto', choices=['auto', 'cv2', 'ffmpeg'], help='video decoder backend')
+    parser.add_argument('--backend', default='torch', choices=['torch', 'onnxruntime'], help='inference backend, onnxruntime needs an .onnx from export.py')
+    parser.add_argument('--ort-threads', type=int, default=0, help='ONNX Runtime intra-op threads, 0 = default')
     parser.add_argument('--conf-thres', type=float, default=0.05, help='object confidence threshold')
     parser.add_argument('--iou-thres', type=float, default=0.45, help='IOU threshold for NMS')
     parser.add_argument('--device', default='', help='cuda device: 0 or 0,1,2,3 or cpu; empty = auto')
@@ -253,17 +529,30 @@ if __name__ == '__main__':
     parser.add_argument('--name', default='exp', help='save results to project/name')
     parser.add_argument('--exist-ok', action='store_true', help='existing project/name ok, do not increment')
     parser.add_argument('--no-trace', action='store_true', help='don`t trace model')
+    parser.add_argument('--model-cache', default='', help='dir for fused/traced deploy models keyed by weights hash, empty = off')
+    parser.add_argument('--exec-mode', default='eager', help='CPU torch execution: eager or a comma list of channels_last, compile, bf16')
+    parser.add_argument('--cache-traced', action='store_true', help='run (and cache) the TorchScript-traced model')
     
     parser.add_argument('--write-log', default='')
     parser.add_argument('--save-json', action='store_true')
-    opt = parser.parse_args()
+    parser.add_argument('--save-npz', action='store_true', help='also save columnar detections (.npz)')
+    parser.add_argument('--render-queue', type=int, default=16, help='annotated video: frames queued for the renderer thread, full = wait')
+    parser.add_argument('--render-scale', type=float, default=1.0, help='annotated video resolution relative to the source')
+    parser.add_argument('--json-buffer', type=int, default=256, help='frames buffered before appending to the .jsonl')
+    opt = parser.parse_args(args)
+    opt.argv = list(sys.argv[1:] if args is None else args)  # re-used for the shard processes
+    return opt
+
+
+if __name__ == '__main__':
+    opt = parse_opt()
     # print(opt)
     #check_requirements(exclude=('pycocotools', 'thop'))
 
     with torch.no_grad():
         if opt.update:  # update all models (to fix SourceChangeWarning)
             for opt.weights in ['yolov7.pt']:
-                detect()
+                detect(opt)
                 strip_optimizer(opt.weights)
         else:
-            detect()
+            detect(opt)
@@ -0,0 +1,161 @@
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+import torchvision
+
+from models.experimental import attempt_load, End2End
+from models.backends import OrtModel, end2end_to_pred
+from models.yolo import Detect, IDetect
+from utils.datasets import LoadImages, letterbox_shape, open_video
+from utils.general import box_iou, check_img_size, non_max_suppression, set_logging
+
+
+def export_onnx(model, img, f, end2end=False, dynamic_batch=False, opset=12, topk=100, iou_thres=0.45,
+                conf_thres=0.25):
+    # Detect head -> one decoded (bs, n, 5 + nc) output, or the ORT NMS (n, 7) output when end2end
+    for m in model.modules():
+        if isinstance(m, (Detect, IDetect)):
+            m.export, m.concat = False, True
+    net = End2End(model, topk, iou_thres, conf_thres, max_wh=4096, device=img.device) if end2end else model
+    dynamic = {'images': {0: 'batch'}, 'output': {0: 'batch'}} if dynamic_batch and not end2end else None
+    torch.onnx.export(net, img, f, verbose=False, opset_version=opset, input_names=['images'],
+                      output_names=['output'], dynamic_axes=dynamic)
+
+    import onnx  # optional dependency, only needed for export
+    onnx_model = onnx.load(f)
+    onnx.checker.check_model(onnx_model)
+    for k, v in {'names': json.dumps(list(model.names)), 'stride': str(int(model.stride.max())),
+                 'end2end': '1' if end2end else '0'}.items():  # read back by models.backends.OrtModel
+        meta = onnx_model.metadata_props.add()
+        meta.key, meta.value = k, v
+    onnx.save(onnx_model, f)
+
+    for m in model.modules():  # back to the eager detect.py configuration for the parity check
+        if isinstance(m, (Detect, IDetect)):
+            m.end2end = m.concat = False
+    return f
+
+
+def sample_frames(source, img_size, stride, n):
+    # First n letterboxed frames of a video / image folder, padded to exactly img_size like detect.py does
+    if not source:
+        return [np.random.randint(0, 256, (3, *img_size), dtype=np.uint8) for _ in range(n)]
+    dataset = LoadImages(source, img_size=img_size, stride=stride, auto=False)
+    frames = []
+    for _, img, _, _ in dataset:
+        frames.append(img)
+        if len(frames) >= n:
+            break
+    return frames
+
+
+def graph_nms(pred, conf_thres, iou_thres, topk):
+    # What the End2End (ONNX_ORT) graph does to raw predictions: best class score obj * cls > conf_thres, one
+    # class-offset NMS, at most topk boxes per image; real scores, the ball included (no forced conf)
+    out = []
+    for x in pred:
+        score, j = (x[:, 5:] * x[:, 4:5]).max(1)
+        k = score > conf_thres
+        box = torch.cat((x[k, :2] - x[k, 2:4] / 2, x[k, :2] + x[k, 2:4] / 2), 1)
+        i = torchvision.ops.batched_nms(box, score[k], j[k], iou_thres)[:topk]
+        out.append(torch.cat((box[i], score[k][i, None], j[k][i, None].float()), 1))
+    return out
+
+
+def parity(model, ort, frames, conf_thres, iou_thres, atol, batch_size=1, topk=100):
+    # Compare the ORT model against the eager model on the same inputs: raw outputs and the detect.py boxes after
+    # NMS for an NMS-free export; an End2End export (not usable by detect.py) against graph_nms() of the eager
+    # output, every class included. Returns a report dict, report['ok'] is False on a mismatch
+    raw_diff, n_torch, n_ort, mismatched, min_iou = 0.0, 0, 0, 0, 1.0
+    t_torch = t_ort = 0.0
+    batches = [frames[i:i + batch_size] for i in range(0, len(frames) - batch_size + 1, batch_size)]
+    for x in batches:
+        img = torch.from_numpy(np.stack(x, 0)).float() / 255.0
+        t = time.time()
+        ref = model(img)[0]
+        t_torch += time.time() - t
+        t = time.time()
+        out = ort(img)[0]
+        t_ort += time.time() - t
+
+        if ort.end2end:
+            pa = graph_nms(ref, conf_thres, iou_thres, topk)
+            pb = end2end_to_pred(out, len(x), conf_thres=conf_thres)
+        else:
+            raw_diff = max(raw_diff, float((ref[..., 4:] - out[..., 4:]).abs().max()))  # obj / cls scores
+            pa = non_max_suppression(ref.clone(), conf_thres, iou_thres)
+            pb = non_max_suppression(out.clone(), conf_thres, iou_thres)
+        for a, b in zip(pa, pb):
+            n_torch, n_ort = n_torch + len(a), n_ort + len(b)
+            if len(a) != len(b):
+                mismatched += 1
+                continue
+            if len(a) and ort.end2end:  # order can differ on near-equal scores: best same-class match per box
+                iou = (box_iou(a[:, :4], b[:, :4]) * (a[:, 5:6] == b[:, 5][None])).max(1)[0]
+                min_iou = min(min_iou, float(iou.min()))
+                if (iou < 0.99).any():
+                    mismatched += 1
+            elif len(a):
+                iou = box_iou(a[:, :4], b[:, :4]).diagonal()  # same NMS order on both sides
+                min_iou = min(min_iou, float(iou.min()))
+                if (a[:, 5] != b[:, 5]).any() or (iou < 0.99).any():
+                    mismatched += 1
+    n = max(sum(len(x) for x in batches), 1)
+    return {'frames': n, 'end2end': ort.end2end, 'max_score_diff': round(raw_diff, 6),
+            'boxes_torch': n_torch, 'boxes_ort': n_ort, 'mismatched_frames': mismatched, 'min_iou': round(min_iou, 4),
+            'torch_ms': round(1E3 * t_torch / n, 1), 'ort_ms': round(1E3 * t_ort / n, 1),
+            'ok': raw_diff <= atol and mismatched == 0}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--weights', type=str, default='yolov7.pt', help='weights path')
+    parser.add_argument('--img-size', nargs='+', type=int, default=[640, 640], help='input (height, width), e.g. the letterboxed video shape 736 1280')
+    parser.add_argument('--batch-size', type=int, default=1, help='batch size')
+    parser.add_argument('--dynamic-batch', action='store_true', help='dynamic batch axis (detect.py --batch-size)')
+    parser.add_argument('--end2end', action='store_true', help='embed ONNX Runtime NMS in the graph (not for detect.py: real ball scores)')
+    parser.add_argument('--topk-all', type=int, default=100, help='end2end: max boxes per image')
+    parser.add_argument('--iou-thres', type=float, default=0.45, help='IOU threshold for NMS')
+    parser.add_argument('--conf-thres', type=float, default=0.05, help='confidence threshold for NMS')
+    parser.add_argument('--opset', type=int, default=12, help='ONNX opset')
+    parser.add_argument('--output', type=str, default='', help='output .onnx, default next to the weights')
+    parser.add_argument('--source', type=str, default='', help='video / image folder for the parity check, empty = random frames')
+    parser.add_argument('--rect', action='store_true', help='export at the letterboxed shape of the first --source frame (long side max(--img-size))')
+    parser.add_argument('--parity-frames', type=int, default=8, help='frames compared against the PyTorch model, 0 = skip')
+    parser.add_argument('--atol', type=float, default=1e-3, help='max allowed score difference')
+    opt = parser.parse_args()
+    opt.img_size *= 2 if len(opt.img_size) == 1 else 1  # expand
+    print(opt)
+    set_logging()
+
+    model = attempt_load(opt.weights, map_location=torch.device('cpu'))  # load FP32 model
+    gs = int(max(model.stride))  # grid size (max stride)
+    opt.img_size = [check_img_size(x, gs) for x in opt.img_size]
+    if opt.rect:  # e.g. 736 x 1280 for 16:9 footage instead of a padded 1280 x 1280
+        assert opt.source, '--rect needs --source'
+        cap = open_video(opt.source)
+        ok, frame = cap.read()
+        cap.release()
+        assert ok, f'cannot read a frame from {opt.source}'
+        opt.img_size = list(letterbox_shape(frame.shape[:2], max(opt.img_size), stride=gs))
+        print(f'--rect: exporting at {opt.img_size[0]}x{opt.img_size[1]}')
+    img = torch.zeros(opt.batch_size, 3, *opt.img_size)
+    f = opt.output or str(Path(opt.weights).with_suffix('.onnx'))
+
+    with torch.no_grad():
+        export_onnx(model, img, f, end2end=opt.end2end, dynamic_batch=opt.dynamic_batch, opset=opt.opset,
+                    topk=opt.topk_all, iou_thres=opt.iou_thres, conf_thres=opt.conf_thres)
+        print(f'ONNX export success, saved as {f}')
+
+        if opt.parity_frames:
+            frames = sample_frames(opt.source, tuple(opt.img_size), gs, max(opt.parity_frames, opt.batch_size))
+            report = parity(model, OrtModel(f), frames, opt.conf_thres, opt.iou_thres, opt.atol,
+                            batch_size=1 if opt.dynamic_batch else opt.batch_size, topk=opt.topk_all)
+            print(json.dumps(report))
+            if not report['ok']:
+                sys.exit(f'parity check failed for {f}')
@@ -0,0 +1,317 @@
+# Inference backends for detect.py: eager PyTorch (attempt_load) or an exported ONNX model on ONNX Runtime
+
+import hashlib
+import json
+import os
+import platform
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from models.experimental import Ensemble, attempt_load
+from utils.general import check_img_size
+from utils.torch_utils import TracedModel
+
+
+class OrtModel:
+    # ONNX Runtime session called like the torch model: model(img)[0] is the raw (bs, n, 5 + nc) prediction,
+    # or the (n, 7) [batch, x1, y1, x2, y2, cls, score] NMS output of an End2End export (self.end2end)
+    def __init__(self, path, threads=0, optimized_path=None):
+        # optimized_path: graph-optimized copy of the model (model cache); loaded without re-optimizing if it
+        # exists, otherwise written by this session
+        import onnxruntime as ort  # optional dependency, only needed for --backend onnxruntime
+
+        so = ort.SessionOptions()
+        so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            so.intra_op_num_threads = threads
+        if optimized_path and Path(optimized_path).exists():
+            path = optimized_path
+            so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+        elif optimized_path:
+            so.optimized_model_filepath = f'{optimized_path}.{os.getpid()}.tmp'
+        self.session = ort.InferenceSession(str(path), so, providers=['CPUExecutionProvider'])
+        if so.optimized_model_filepath and Path(so.optimized_model_filepath).exists():
+            os.replace(so.optimized_model_filepath, optimized_path)  # atomic, concurrent jobs never see a partial file
+        inp = self.session.get_inputs()[0]
+        self.input_name = inp.name
+        b, _, h, w = inp.shape
+        self.batch = b if isinstance(b, int) else None  # static batch: short batches are zero-padded
+        self.img_size = (h, w) if isinstance(h, int) and isinstance(w, int) else None  # None = dynamic shape
+
+        meta = self.session.get_modelmeta().custom_metadata_map  # written by export.py
+        self.names = json.loads(meta['names']) if 'names' in meta else [str(i) for i in range(self._nc())]
+        self.stride = torch.tensor([float(meta.get('stride', 32))])
+        out = self.session.get_outputs()[0].shape
+        self.end2end = meta.get('end2end') == '1' if 'end2end' in meta else len(out) == 2 and out[-1] == 7
+
+    def _nc(self):
+        return int(self.session.get_outputs()[0].shape[-1]) - 5
+
+    def __call__(self, img, augment=False):
+        x = img.cpu().numpy().astype(np.float32)
+        n = len(x)
+        if self.batch and n < self.batch:
+            x = np.concatenate((x, np.zeros((self.batch - n, *x.shape[1:]), dtype=np.float32)), 0)
+        out = torch.from_numpy(self.session.run(None, {self.input_name: x})[0])
+        if self.batch and n < self.batch:
+            out = out[out[:, 0] < n] if self.end2end else out[:n]
+        return out, None
+
+    def half(self):
+        return self  # fp32 only
+
+    def eval(self):
+        return self
+
+
+EXEC_MODES = ('channels_last', 'compile', 'bf16')
+
+
+def _cpu_bf16():
+    # bf16 autocast only pays off with native bf16 instructions (AVX512-BF16 / AMX)
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return torch.backends.mkldnn.is_available() and ('avx512_bf16' in flags or 'amx_bf16' in flags)
+
+
+def check_exec(y, ref, modes):
+    # Raise if an exec-mode output disagrees with the eager fp32 one
+    tol = 0.05 if 'bf16' in modes else 1E-3  # objectness / class scores
+    if not torch.isfinite(y).all() or not torch.allclose(y[..., 4:], ref[..., 4:], atol=tol, rtol=0):
+        raise RuntimeError(f'outputs differ from eager by {(y[..., 4:] - ref[..., 4:]).abs().max():.4f}')
+
+
+class ExecModel:
+    # Eager torch model run in a CPU execution mode: any of channels_last memory format, torch.compile (inductor,
+    # kernels cached in <cache_dir>/inductor between runs) and bf16 autocast. Called like the model, the output is
+    # always fp32; names / stride / ... come from the wrapped model. The first batch of every input shape (letterboxed
+    # frames are rarely the square self-check shape; compile re-traces per shape) is checked against eager fp32, an
+    # error or a mismatch runs that shape eager from then on
+    def __init__(self, model, modes):
+        self.model, self.modes = model, tuple(modes)
+        self.shapes = {}  # input shape -> passed the check against eager
+        if 'channels_last' in self.modes:
+            model.to(memory_format=torch.channels_last)
+        self.fn = torch.compile(model, backend='inductor') if 'compile' in self.modes else model
+
+    def _run(self, img):
+        if 'channels_last' in self.modes:
+            img = img.contiguous(memory_format=torch.channels_last)
+        with torch.autocast('cpu', dtype=torch.bfloat16, enabled='bf16' in self.modes):
+            out = self.fn(img)
+        return out[0].float()
+
+    def __call__(self, img, augment=False):
+        if augment:  # test-time augmentation is eager only
+            return self.model(img.contiguous(), augment=True)
+        shape = tuple(img.shape)
+        if shape not in self.shapes:
+            ref = self.model(img.contiguous())[0].float()
+            try:
+                y = self._run(img)
+                check_exec(y, ref, self.modes)
+            except Exception as e:
+                print(f'exec mode {",".join(self.modes)} failed on input {list(shape)} ({e}), running it eager')
+                self.shapes[shape] = False
+                return ref, None
+            self.shapes[shape] = True
+            return y, None
+        if not self.shapes[shape]:
+            return self.model(img.contiguous())[0].float(), None
+        return self._run(img), None
+
+    def __getattr__(self, name):  # names, stride, ... of the wrapped model
+        return getattr(self.model, name)
+
+
+def exec_mode(model, mode, device, img_size=640, cache_dir='', runs=3):
+    # Wrap an eager torch model in --exec-mode (comma-separated EXEC_MODES). Self-check on a random square input: an
+    # error or outputs that disagree with eager fall back to the eager model (ExecModel checks the other shapes).
+    # Logs the mode and its ms/frame
+    modes = [m for m in str(mode).split(',') if m and m != 'eager']
+    unknown = set(modes) - set(EXEC_MODES)
+    assert not unknown, f'unknown --exec-mode {unknown}, choose from eager,{",".join(EXEC_MODES)}'
+    if not modes:
+        return model
+    if device.type != 'cpu' or isinstance(model, (OrtModel, TraceCache, Ensemble)):
+        print(f'exec mode {mode}: needs a single eager torch model on CPU, running eager')
+        return model
+    if 'bf16' in modes and not _cpu_bf16():
+        print('exec mode: no native bf16 on this CPU, bf16 dropped')
+        modes.remove('bf16')
+    if 'compile' in modes and cache_dir:
+        os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', str(Path(cache_dir) / 'inductor'))
+        os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+
+    imgsz = check_img_size(img_size, s=int(model.stride.max()))
+    x = torch.rand(1, 3, imgsz, imgsz, generator=torch.Generator().manual_seed(0))
+
+    def timed(m):
+        with torch.no_grad():
+            y = m(x)[0]  # warm-up (compilation happens here)
+            t = time.time()
+            for _ in range(runs):
+                m(x)
+        return y.float(), (time.time() - t) * 1E3 / runs
+
+    ref, t_eager = timed(model)
+    try:
+        wrapped = ExecModel(model, modes)
+        y, t = timed(lambda im: (wrapped._run(im),))
+        check_exec(y, ref, modes)
+        wrapped.shapes[tuple(x.shape)] = True
+    except Exception as e:
+        print(f'exec mode {",".join(modes)} failed the self-check ({e}), running eager: {t_eager:.1f}ms/frame')
+        model.to(memory_format=torch.contiguous_format)
+        return model
+    print(f'exec mode {",".join(modes)}: {t:.1f}ms/frame (eager {t_eager:.1f}ms/frame)')
+    return wrapped
+
+
+def end2end_to_pred(out, bs, conf_thres=0.0):
+    # (n, 7) End2End output -> per-image list of (k, 6) [xyxy, conf, cls], the non_max_suppression() layout, with
+    # the real scores (no forced ball conf: detect.py refuses End2End models); boxes scoring <= conf_thres dropped
+    out = out.float()
+    pred = []
+    for i in range(bs):
+        x = out[(out[:, 0] == i) & (out[:, 6] > conf_thres)]
+        det = torch.cat((x[:, 1:5], x[:, 6:7], x[:, 5:6]), 1)
+        pred.append(det[det[:, 4].argsort(descending=True, stable=True)])
+    return pred
+
+
+def file_hash(path, cache_dir=None):
+    # sha256 of a weights file; remembered in <cache_dir>/hashes.json by (path, size, mtime) so unchanged files
+    # are not re-read on every job
+    st = os.stat(path)
+    stamp = f'{Path(path).resolve()}:{st.st_size}:{st.st_mtime_ns}'
+    index = Path(cache_dir) / 'hashes.json' if cache_dir else None
+    known = {}
+    if index and index.exists():
+        try:
+            known = json.loads(index.read_text())
+        except ValueError:
+            known = {}
+    if stamp in known:
+        return known[stamp]
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    known[stamp] = h.hexdigest()
+    if index:
+        _atomic_write(index, lambda p: Path(p).write_text(json.dumps(known)))
+    return known[stamp]
+
+
+def cache_key(weights, backend, img_size, cache_dir=None, traced=False):
+    # Deploy artifacts depend on the weights contents, the input size, the backend and the runtime that built them
+    weights = weights if isinstance(weights, (list, tuple)) else [weights]
+    parts = [file_hash(w, cache_dir) for w in weights]
+    parts += [backend, str(img_size), 'traced' if traced else 'eager', torch.__version__, platform.machine()]
+    return hashlib.sha256('|'.join(parts).encode()).hexdigest()[:16]
+
+
+def _atomic_write(path, save):
+    # Write to a temp file and rename, so concurrent jobs never load a half-written artifact
+    tmp = Path(f'{path}.{os.getpid()}.tmp')
+    try:
+        save(tmp)
+        os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+class TraceCache:
+    # Eager torch model + one TorchScript trace per letterboxed input shape (h, w), traced on the first batch of
+    # that shape (the video's letterboxed frame shape, not a padded square) and kept in memory and, with a
+    # cache_dir, in <cache_dir>/<key>.pt for the next runs. Called like the model; shapes beyond max_shapes
+    # run eager
+    def __init__(self, model, weights, device, cache_dir='', max_shapes=4):
+        self.model, self.weights, self.device, self.cache_dir = model, weights, device, cache_dir
+        self.max_shapes = max_shapes
+        self.traced = {}  # (h, w) -> TracedModel
+
+    def get(self, shape):
+        shape = tuple(int(v) for v in shape)
+        if shape in self.traced:
+            return self.traced[shape]
+        if len(self.traced) >= self.max_shapes:
+            return None
+        half = next(self.model.parameters()).dtype == torch.float16
+        if half:  # traced in fp32 on CPU like an unconverted model
+            self.model.float()
+        f = None
+        if self.cache_dir:
+            f = Path(self.cache_dir) / f'{cache_key(self.weights, "torch", "x".join(map(str, shape)), self.cache_dir, traced=True)}.pt'
+        if f is not None and f.exists():
+            m = TracedModel(self.model, self.device, shape, traced=torch.jit.load(str(f), map_location='cpu'))
+            print(f'traced model cache hit {f} {shape}')
+        else:
+            m = TracedModel(self.model, self.device, shape)
+            if f is not None:
+                _atomic_write(f, lambda p: torch.jit.save(m.model, str(p)))
+        self.model.traced = False  # TracedModel flags the eager model, which stays usable for other shapes
+        self.model.to(self.device)
+        if half:
+            self.model.half()
+            m.half()
+        self.traced[shape] = m
+        return m
+
+    def __call__(self, img, augment=False):
+        m = None if augment else self.get(img.shape[2:])
+        return (m or self.model)(img, augment=augment)
+
+    def half(self):
+        self.model.half()
+        for m in self.traced.values():
+            m.half()
+        return self
+
+    def __getattr__(self, name):  # names, stride, ... of the eager model
+        return getattr(self.model, name)
+
+
+def load_cached(weights, device, img_size, cache_dir, trace=False):
+    # Fused (and optionally traced) torch model from <cache_dir>/<key>.pt, built by attempt_load() on a miss.
+    # A hit is one mmap-backed torch.load, no checkpoint unpickling of the training model and no re-fusing
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    key = cache_key(weights, 'torch', img_size, cache_dir)
+    f = cache_dir / f'{key}.pt'
+    if f.exists():
+        model = torch.load(f, map_location=device, mmap=True, weights_only=False)
+        print(f'model cache hit {f}')
+    else:
+        model = attempt_load(weights, map_location='cpu')  # load FP32 model
+        _atomic_write(f, lambda p: torch.save(model, p))
+        model.to(device)
+        print(f'model cache stored {f}')
+    return TraceCache(model, weights, device, cache_dir) if trace else model
+
+
+def load_model(weights, backend='torch', device=None, threads=0, img_size=640, cache_dir='', trace=False):
+    # weights: .pt path(s) for torch, a single .onnx path for onnxruntime
+    # cache_dir: keep deploy artifacts (fused / traced torch model, graph-optimized ONNX) between jobs
+    if backend == 'torch':
+        if cache_dir:
+            return load_cached(weights, device, img_size, cache_dir, trace=trace)
+        model = attempt_load(weights, map_location=device)
+        return TraceCache(model, weights, device) if trace else model
+    if backend == 'onnxruntime':
+        w = weights[0] if isinstance(weights, (list, tuple)) else weights
+        assert str(w).endswith('.onnx'), f'--backend onnxruntime needs an .onnx model (see export.py), got {w}'
+        opt = None
+        if cache_dir:
+            Path(cache_dir).mkdir(parents=True, exist_ok=True)
+            opt = Path(cache_dir) / f'{cache_key(w, backend, img_size, cache_dir)}.onnx'
+        return OrtModel(w, threads=threads, optimized_path=opt)
+    raise ValueError(f'unknown backend {backend}')
@@ -1,7 +1,10 @@
-import numpy as np
 import random
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from models.common import Conv, DWConv
 from utils.google_utils import attempt_download
@@ -67,14 +70,55 @@ class MixConv2d(nn.Module):
 
 
 class Ensemble(nn.ModuleList):
-    # Ensemble of models
+    # Ensemble of models; the members run concurrently in threads on the shared input tensor
     def __init__(self):
         super(Ensemble, self).__init__()
+        self.configure()
+
+    def configure(self, img_sizes=None, classes=None, threads=0):
+        # img_sizes[i]: member i's input long side (the shared input is resized, predictions are mapped back),
+        # 0 = the shared input; classes[i]: class indices member i contributes, None = all; threads: intra-op
+        # threads per member, 0 = torch's thread count // members (all members must share the class list)
+        n = len(self)
+        self.img_sizes = (list(img_sizes or []) + [0] * n)[:n]
+        self.member_classes = (list(classes or []) + [None] * n)[:n]
+        self.threads = threads or max(1, torch.get_num_threads() // max(n, 1))
+        return self
+
+    def __getstate__(self):  # torch.save() (model cache): the thread pool is per process
+        state = self.__dict__.copy()
+        state.pop('_pool', None)
+        return state
+
+    def _member(self, i, x, augment):
+        if getattr(self, '_pool', None) is not None:
+            torch.set_num_threads(self.threads)  # the OpenMP thread count is per calling thread
+        m, size, classes = self[i], self.img_sizes[i], self.member_classes[i]
+        h, w = x.shape[2:]
+        if size and size != max(h, w):
+            s = int(m.stride.max())
+            hm, wm = (max(round(v * size / max(h, w) / s), 1) * s for v in (h, w))
+            y = m(F.interpolate(x, size=(hm, wm), mode='bilinear', align_corners=False), augment)[0]
+            y[..., [0, 2]] *= w / wm  # xywh back to the shared input's pixels
+            y[..., [1, 3]] *= h / hm
+        else:
+            y = m(x, augment)[0]
+        if classes is not None:  # candidates whose best class is not the member's drop out before NMS
+            keep = torch.zeros(y.shape[2] - 5, device=y.device, dtype=torch.bool)
+            keep[classes] = True
+            y[..., 4] *= keep[y[..., 5:].argmax(-1)].to(y.dtype)
+            y[..., 5:] *= keep.to(y.dtype)
+        return y
 
     def forward(self, x, augment=False):
-        y = []
-        for module in self:
-            y.append(module(x, augment)[0])
+        if len(getattr(self, 'img_sizes', ())) != len(self):  # not configured (members appended / older pickle)
+            self.configure()
+        if len(self) > 1 and not torch.jit.is_tracing():  # the tracer only records the calling thread
+            if getattr(self, '_pool', None) is None:
+                self._pool = ThreadPoolExecutor(len(self), thread_name_prefix='ensemble')
+            y = list(self._pool.map(lambda i: self._member(i, x, augment), range(len(self))))
+        else:
+            y = [self._member(i, x, augment) for i in range(len(self))]
         # y = torch.stack(y).max(0)[0]  # max ensemble
         # y = torch.stack(y).mean(0)  # mean ensemble
         y = torch.cat(y, 1)  # nms ensemble
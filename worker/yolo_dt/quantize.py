@@ -0,0 +1,162 @@
+import argparse
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+from onnxruntime.quantization import CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType, \
+    quantize_static
+
+from export import export_onnx
+from models.backends import OrtModel
+from models.experimental import attempt_load
+from utils.datasets import LoadImages
+from utils.general import box_iou, check_img_size, non_max_suppression, set_logging
+
+
+def iter_frames(source, img_size, stride, n, step=1):
+    # Every step-th letterboxed frame of the videos / images under source, at most n, padded to exactly img_size
+    dataset = LoadImages(source, img_size=img_size, stride=stride, auto=False)
+    k = 0
+    for i, (_, img, _, _) in enumerate(dataset):
+        if i % step:
+            continue
+        yield img
+        k += 1
+        if k >= n:
+            break
+
+
+class FrameReader(CalibrationDataReader):
+    # Feeds calibration frames to quantize_static() as {input: (1, 3, h, w) float32}
+    def __init__(self, frames, input_name='images'):
+        self.frames = iter(frames)
+        self.input_name = input_name
+        self.n = 0
+
+    def get_next(self):
+        img = next(self.frames, None)
+        if img is None:
+            return None
+        self.n += 1
+        return {self.input_name: (img[None].astype(np.float32) / 255.0)}
+
+
+def head_nodes(onnx_path, head):
+    # Node names of the Detect layer (model.<head>), kept in FP32: box decoding is sensitive to INT8 error
+    import onnx
+    return [n.name for n in onnx.load(onnx_path).graph.node if f'/model.{head}/' in n.name]
+
+
+def copy_metadata(src, dst):
+    # quantize_static() drops custom metadata; names/stride/end2end are needed by OrtModel
+    import onnx
+    a, b = onnx.load(src), onnx.load(dst)
+    del b.metadata_props[:]
+    b.metadata_props.extend(a.metadata_props)
+    onnx.save(b, dst)
+
+
+def _ms(t):
+    return {'mean': round(1E3 * float(np.mean(t)), 1), 'p50': round(1E3 * float(np.median(t)), 1),
+            'p95': round(1E3 * float(np.percentile(t, 95)), 1)} if len(t) else {}
+
+
+def latency(model, frames):
+    # Per-frame forward latency (ms) of a model on letterboxed frames
+    t = []
+    for x in frames:
+        img = torch.from_numpy(x).float().unsqueeze(0) / 255.0
+        t0 = time.time()
+        model(img)
+        t.append(time.time() - t0)
+    return _ms(t)
+
+
+def evaluate(ref, model, frames, classes, conf_thres, iou_thres, match_iou=0.5):
+    # Recall of each class against the reference model's detections on the same frames + per-frame forward latency
+    # (NMS not timed, like latency(), so every latency in the report measures the same thing)
+    hits = {c: 0 for c in classes}
+    total = {c: 0 for c in classes}
+    t_ref, t_model = [], []
+    for x in frames:
+        img = torch.from_numpy(x).float().unsqueeze(0) / 255.0
+        t = time.time()
+        a = ref(img)[0]
+        t_ref.append(time.time() - t)
+        t = time.time()
+        b = model(img)[0]
+        t_model.append(time.time() - t)
+        a = non_max_suppression(a, conf_thres, iou_thres)[0]
+        b = non_max_suppression(b, conf_thres, iou_thres)[0]
+        for c in classes:
+            ac, bc = a[a[:, 5] == c], b[b[:, 5] == c]
+            total[c] += len(ac)
+            if len(ac) and len(bc):
+                hits[c] += int((box_iou(ac[:, :4], bc[:, :4]).max(1)[0] >= match_iou).sum())
+    return {'recall': {c: round(hits[c] / total[c], 4) if total[c] else None for c in classes},
+            'boxes': total, 'latency_ref_ms': _ms(t_ref), 'latency_ms': _ms(t_model), 'frames': len(t_ref)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--weights', type=str, default='yolov7.pt', help='FP32 weights path')
+    parser.add_argument('--onnx', type=str, default='', help='FP32 .onnx from export.py, empty = export it here')
+    parser.add_argument('--img-size', nargs='+', type=int, default=[640, 640], help='input (height, width)')
+    parser.add_argument('--calib', type=str, required=True, help='folder of frames / clips sampled from real uploads')
+    parser.add_argument('--calib-frames', type=int, default=300, help='calibration frames')
+    parser.add_argument('--calib-step', type=int, default=15, help='take every k-th frame of calibration videos')
+    parser.add_argument('--method', default='minmax', choices=['minmax', 'entropy', 'percentile'], help='activation range calibration')
+    parser.add_argument('--keep-head-fp32', action='store_true', help='leave the Detect layer in FP32')
+    parser.add_argument('--output', type=str, default='', help='INT8 .onnx, default <weights>.int8.onnx')
+    parser.add_argument('--eval-source', type=str, default='', help='held-out clip for the FP32 vs INT8 report')
+    parser.add_argument('--eval-frames', type=int, default=300, help='frames of the held-out clip to evaluate')
+    parser.add_argument('--conf-thres', type=float, default=0.05, help='object confidence threshold')
+    parser.add_argument('--iou-thres', type=float, default=0.45, help='IOU threshold for NMS')
+    parser.add_argument('--report', type=str, default='', help='report .json, default next to the INT8 model')
+    opt = parser.parse_args()
+    opt.img_size *= 2 if len(opt.img_size) == 1 else 1  # expand
+    print(opt)
+    set_logging()
+
+    model = attempt_load(opt.weights, map_location=torch.device('cpu'))  # fused FP32 model
+    gs = int(max(model.stride))  # grid size (max stride)
+    opt.img_size = [check_img_size(x, gs) for x in opt.img_size]
+    img_size = tuple(opt.img_size)
+    fp32 = opt.onnx or str(Path(opt.weights).with_suffix('.onnx'))
+    int8 = opt.output or str(Path(opt.weights).with_suffix('.int8.onnx'))
+
+    with torch.no_grad():
+        if not opt.onnx:
+            export_onnx(model, torch.zeros(1, 3, *img_size), fp32)
+            print(f'FP32 ONNX saved as {fp32}')
+        assert OrtModel(fp32).img_size == img_size, f'{fp32} was exported for another --img-size'
+
+        reader = FrameReader(iter_frames(opt.calib, img_size, gs, opt.calib_frames, opt.calib_step))
+        method = {'minmax': CalibrationMethod.MinMax, 'entropy': CalibrationMethod.Entropy,
+                  'percentile': CalibrationMethod.Percentile}[opt.method]
+        exclude = head_nodes(fp32, len(model.model) - 1) if opt.keep_head_fp32 else []
+        t = time.time()
+        quantize_static(fp32, int8, reader, quant_format=QuantFormat.QDQ, per_channel=True,
+                        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8, calibrate_method=method,
+                        nodes_to_exclude=exclude)
+        copy_metadata(fp32, int8)
+        print(f'INT8 ONNX saved as {int8} ({reader.n} calibration frames, {time.time() - t:.1f}s)')
+
+        if opt.eval_source:
+            classes = {c: n for c, n in enumerate(model.names) if n in ('person', 'ball')} or \
+                dict(enumerate(model.names))
+            frames = list(iter_frames(opt.eval_source, img_size, gs, opt.eval_frames))
+            r = evaluate(model, OrtModel(int8), frames, list(classes), opt.conf_thres, opt.iou_thres)
+            report = {'fp32': opt.weights, 'int8': int8, 'img_size': img_size, 'calib_frames': reader.n,
+                      'method': opt.method, 'keep_head_fp32': opt.keep_head_fp32, 'frames': r['frames'],
+                      'recall_vs_fp32': {classes[c]: v for c, v in r['recall'].items()},
+                      'fp32_boxes': {classes[c]: v for c, v in r['boxes'].items()},
+                      'latency_fp32_ms': r['latency_ref_ms'], 'latency_int8_ms': r['latency_ms'],
+                      'latency_fp32_ort_ms': latency(OrtModel(fp32), frames)}
+            f = opt.report or str(Path(int8).with_suffix('.json'))
+            with open(f, 'w') as fp:
+                json.dump(report, fp, indent=2)
+            print(json.dumps(report))
+            print(f'report saved as {f}')
@@ -4,13 +4,15 @@ import glob
 import logging
 import math
 import os
+import queue
 import random
 import shutil
+import sys
 import time
 from itertools import repeat
 from multiprocessing.pool import ThreadPool
 from pathlib import Path
-from threading import Thread
+from threading import Thread, Event
 
 import cv2
 import numpy as np
@@ -19,7 +21,6 @@ import torch.nn.functional as F
 from PIL import Image, ExifTags
 from torch.utils.data import Dataset
 from tqdm import tqdm
-import copy
 import pickle
 from copy import deepcopy
 #from pycocotools import mask as maskUtils
@@ -30,12 +31,16 @@ from utils.general import check_requirements, xyxy2xywh, xywh2xyxy, xywhn2xyxy,
     resample_segments, clean_str
 from utils.torch_utils import torch_distributed_zero_first
 
+sys.path.append(str(Path(__file__).resolve().parents[2]))  # worker/ (videoio.py)
+from videoio import open_video
+from utils.tiles import tile_grid, tile_views
+
 np.int = np.int64
 
 # Parameters
 help_url = 'https://github.com/ultralytics/yolov5/wiki/Train-Custom-Data'
 img_formats = ['bmp', 'jpg', 'jpeg', 'png', 'tif', 'tiff', 'dng', 'webp', 'mpo']  # acceptable image suffixes
-vid_formats = ['mov', 'avi', 'mp4', 'mpg', 'mpeg', 'm4v', 'wmv', 'mkv']  # acceptable video suffixes
+vid_formats = ['mov', 'avi', 'mp4', 'mpg', 'mpeg', 'm4v', 'wmv', 'mkv', 'ts', 'mts', 'm2ts', 'webm', 'flv', '3gp']  # acceptable video suffixes
 logger = logging.getLogger(__name__)
 
 # Get orientation exif tag
@@ -128,7 +133,7 @@ class _RepeatSampler(object):
 
 
 class LoadImages:  # for inference
-    def __init__(self, path, img_size=640, stride=32):
+    def __init__(self, path, img_size=640, stride=32, decoder='auto', auto=True):
         p = str(Path(path).absolute())  # os-agnostic absolute path
         if '*' in p:
             files = sorted(glob.glob(p, recursive=True))  # glob
@@ -145,6 +150,11 @@ class LoadImages:  # for inference
         
         self.img_size = img_size
         self.stride = stride
+        self.decoder = decoder  # 'auto' (cv2, ffmpeg if cv2 fails), 'cv2' or 'ffmpeg'
+        self.auto = auto  # False: pad to exactly img_size (static-shape ONNX models)
+        self.limit = None  # frames left in a --frame-range shard, None = no limit
+        self.crop = None  # (x1, y1, x2, y2): letterbox only this region (pitch ROI), img0 stays the full frame
+        self.tiles = None  # (rows, cols, overlap): img is the (T, 3, h, w) stack of letterboxed tiles
         self.files = images + videos
         self.nf = ni + nv  # number of files
         self.video_flag = [False] * ni + [True] * nv
@@ -163,6 +173,10 @@ class LoadImages:  # for inference
     def __next__(self):
         if self.count == self.nf:
             raise StopIteration
+        if self.limit is not None:
+            if self.limit <= 0:
+                raise StopIteration
+            self.limit -= 1
         path = self.files[self.count]
 
         if self.video_flag[self.count]:
@@ -190,7 +204,15 @@ class LoadImages:  # for inference
             #print(f'image {self.count}/{self.nf} {path}: ', end='')
 
         # Padded resize
-        img = letterbox(img0, self.img_size, stride=self.stride)[0]
+        if self.tiles:  # equal tiles, letterboxed to one shape so they stack into a batch
+            grid = tile_grid(*img0.shape[:2], *self.tiles, region=self.crop)
+            img = np.stack([letterbox(t, self.img_size, stride=self.stride, auto=False)[0]
+                            for t in tile_views(img0, grid)], 0)
+            img = np.ascontiguousarray(img[..., ::-1].transpose(0, 3, 1, 2))  # BGR to RGB, to Tx3xhxw
+            return path, img, img0, self.cap
+
+        src = img0 if self.crop is None else img0[self.crop[1]:self.crop[3], self.crop[0]:self.crop[2]]  # view
+        img = letterbox(src, self.img_size, stride=self.stride, auto=self.auto)[0]
         
         # Convert
         img = img[:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, to 3x416x416
@@ -200,9 +222,21 @@ class LoadImages:  # for inference
 
     def new_video(self, path):
         self.frame = 0
-        self.cap = cv2.VideoCapture(path)
+        self.cap = open_video(path, self.decoder)
         self.nframes = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
 
+    def set_range(self, skip=0, limit=None):
+        # Shard mode (detect.py --frame-range): skip the next `skip` frames of the current video, then stop after
+        # `limit` more frames. Readers that seek frame-exactly (exact_seek: the ffmpeg reader on constant frame rate
+        # video) jump straight to the start; anything else grab()s its way there, since CAP_PROP_POS_FRAMES seeking
+        # in cv2 is not frame-exact for every codec
+        target = self.frame + skip
+        if skip and getattr(self.cap, 'exact_seek', False) and self.cap.set(cv2.CAP_PROP_POS_FRAMES, target):
+            self.frame = target
+        while self.frame < target and self.cap is not None and self.cap.grab():
+            self.frame += 1
+        self.limit = limit
+
     def __len__(self):
         return self.nf  # number of files
 
@@ -272,22 +306,9 @@ class LoadImages_for_football:  # for inference
         imgs_for_pred = []
         imgs_for_draw = []
         
-        for idx in range(4):
-            # img = np.array((while_game_img.shape[0] // 2 + 1, while_game_img.shape[1] // 2 + 1, 3))
-            if(idx == 0):                                                               #left_top
-                cut_img = while_game_img[:while_game_img.shape[0] // 2, :while_game_img.shape[1] // 2, :]
-                draw = copy.deepcopy(cut_img)
-            elif(idx == 1):                                                             #right_top
-                cut_img = while_game_img[:while_game_img.shape[0] // 2, while_game_img.shape[1] // 2:, :]
-                draw = copy.deepcopy(cut_img)
-            elif(idx == 2):                                                             #left_down
-                cut_img = while_game_img[while_game_img.shape[0] // 2:, :while_game_img.shape[1] // 2, :]
-                draw = copy.deepcopy(cut_img)
-            else:                                                                       #right_down
-                cut_img = while_game_img[while_game_img.shape[0] // 2:, while_game_img.shape[1] // 2:, :]
-                draw = copy.deepcopy(cut_img)
-            # print(cut_img.shape)
-                # Padded resize
+        # Quadrants as zero-copy views (left_top, right_top, left_down, right_down); draw on a copy if needed
+        for cut_img in tile_views(while_game_img, tile_grid(*while_game_img.shape[:2], 2, 2)):
+            # Padded resize
             img = letterbox(cut_img, self.img_size, stride=self.stride, scaleup = False)[0]
 
             # Convert
@@ -295,8 +316,7 @@ class LoadImages_for_football:  # for inference
             img = np.ascontiguousarray(img)
             
             imgs_for_pred.append(img)
-            imgs_for_draw.append(draw)
-            # print(img.shape)
+            imgs_for_draw.append(cut_img)
         
 
         return path, imgs_for_pred, imgs_for_draw, while_game_img, self.cap
@@ -451,6 +471,86 @@ class LoadStreams:  # multiple IP or RTSP cameras
         return 0  # 1E12 frames = 32 streams at 30 FPS for 30 years
 
 
+class PrefetchLoader:  # decode + letterbox in a background thread
+    def __init__(self, dataset, depth=4):
+        self.dataset = dataset
+        self.depth = max(int(depth), 1)  # queue size (frames)
+        self.mode = getattr(dataset, 'mode', 'image')
+        self.frame = 0
+        self.stall = 0.0  # seconds the consumer waited on an empty queue
+        self.thread = None
+
+    @staticmethod
+    def _put(q, stop, item):
+        # Blocking put that gives up once the consumer has stopped
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self, q, stop):
+        try:
+            for path, img, im0s, vid_cap in self.dataset:
+                item = (path, img, im0s, vid_cap, getattr(self.dataset, 'frame', 0), self.dataset.mode)
+                if not self._put(q, stop, item):
+                    return
+        except Exception as e:  # re-raised on the consumer side
+            self._put(q, stop, e)
+            return
+        self._put(q, stop, None)  # end of dataset
+
+    def __iter__(self):
+        self.close()
+        self.queue = queue.Queue(maxsize=self.depth)
+        self.stop = Event()
+        self.thread = Thread(target=self._produce, args=(self.queue, self.stop), daemon=True)
+        self.thread.start()
+        return self
+
+    def __next__(self):
+        t = time.time()
+        item = self.queue.get()
+        self.stall += time.time() - t
+        if item is None:
+            raise StopIteration
+        if isinstance(item, Exception):
+            raise item
+        path, img, im0s, vid_cap, self.frame, self.mode = item
+        return path, img, im0s, vid_cap
+
+    def close(self):
+        if self.thread is not None:
+            self.stop.set()
+            self.thread.join()
+            self.thread = None
+
+    def __getattr__(self, name):  # cap, nframes, count... of the wrapped dataset
+        return getattr(self.dataset, name)
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def batch_frames(dataset, batch_size=1):
+    # Group consecutive (path, img, im0s, vid_cap, frame) items of an inference dataset into lists of <= batch_size
+    # A batch is flushed early when the source file or the letterboxed shape changes, so every batch can be stacked
+    batch = []
+    for path, img, im0s, vid_cap in dataset:
+        frame = getattr(dataset, 'frame', 0)  # read now, the dataset advances it on the next item
+        if batch and (path != batch[-1][0] or img.shape != batch[-1][1].shape):
+            yield batch
+            batch = []
+        batch.append((path, img, im0s, vid_cap, frame))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 def img2label_paths(img_paths):
     # Define label paths as a function of image paths
     sa, sb = os.sep + 'images' + os.sep, os.sep + 'labels' + os.sep  # /images/, /labels/ substrings
@@ -1092,6 +1192,17 @@ def replicate(img, labels):
     return img, labels
 
 
+def letterbox_shape(shape, new_shape=640, stride=32, auto=True):
+    # (h, w) letterbox() produces for an image of shape (h0, w0), e.g. 736 x 1280 for 1080p at 1280, auto=True
+    if isinstance(new_shape, int):
+        new_shape = (new_shape, new_shape)
+    r = min(new_shape[0] / shape[0], new_shape[1] / shape[1])
+    h, w = int(round(shape[0] * r)), int(round(shape[1] * r))
+    if not auto:
+        return tuple(new_shape)
+    return h + (new_shape[0] - h) % stride, w + (new_shape[1] - w) % stride
+
+
 def letterbox(img, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleFill=False, scaleup=True, stride=32):
     # Resize and pad image while meeting stride-multiple constraints
     shape = img.shape[:2]  # current shape [height, width]
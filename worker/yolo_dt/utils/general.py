@@ -707,6 +707,54 @@ def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=Non
     return output
 
 
+def batched_nms(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, class_conf=None,
+                max_det=300, max_nms=30000):
+    """Same result as non_max_suppression() for a whole batch with one torchvision.ops.batched_nms() call
+
+    Candidates of all images are filtered (objectness, class, per-class conf, top max_nms per image) before any
+    box conversion; boxes are kept apart per image (and per class unless agnostic) by batched_nms' offsets.
+    class_conf: {class index: min obj_conf * cls_conf} on top of conf_thres, for the classes listed
+
+    Returns:
+         list of detections, on (n,6) tensor per image [xyxy, conf, cls]
+    """
+
+    bs, nc = prediction.shape[0], prediction.shape[2] - 5  # batch size, number of classes
+    b, k = (prediction[..., 4] > conf_thres).nonzero(as_tuple=True)  # candidates: image, anchor
+    x = prediction[b, k]
+
+    # Compute conf
+    score, j = (x[:, 5:] * x[:, 4:5] if nc > 1 else x[:, 4:5]).max(1)  # best class only
+    conf = score.clone()
+    conf[j == 1] = 1.0  # as non_max_suppression(): the ball always survives NMS
+    keep = conf > conf_thres
+    if class_conf:
+        thres = torch.zeros(max(nc, 1), device=x.device, dtype=score.dtype)
+        for c, v in class_conf.items():
+            thres[int(c)] = v
+        keep &= score > thres[j]
+    if classes is not None:
+        keep &= (j[:, None] == torch.tensor(classes, device=x.device)).any(1)
+    b, x, conf, j = b[keep], x[keep], conf[keep], j[keep]
+
+    # Top max_nms per image, by confidence
+    if len(b) and torch.bincount(b, minlength=bs).max() > max_nms:
+        i = conf.argsort(descending=True)
+        i = i[b[i].argsort(stable=True)]  # grouped by image, confidence order within each image
+        rank = torch.arange(len(i), device=x.device) - torch.searchsorted(b[i], b[i])
+        i = i[rank < max_nms]
+        b, x, conf, j = b[i], x[i], conf[i], j[i]
+
+    # Box (center x, center y, width, height) to (x1, y1, x2, y2), NMS per image (and class)
+    dets = torch.cat((xywh2xyxy(x[:, :4]), conf[:, None], j[:, None].float()), 1)
+    i = torchvision.ops.batched_nms(dets[:, :4], conf, b if agnostic else b * max(nc, 1) + j, iou_thres)
+    i = i[b[i].argsort(stable=True)]  # still in confidence order within each image
+    b = b[i]
+    rank = torch.arange(len(i), device=x.device) - torch.searchsorted(b, b)
+    i, b = i[rank < max_det], b[rank < max_det]
+    return list(dets[i].split(torch.bincount(b, minlength=bs).tolist()))
+
+
 def non_max_suppression_kpt(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, multi_label=False,
                         labels=(), kpt_label=False, nc=None, nkpt=None):
     """Runs Non-Maximum Suppression (NMS) on inference results
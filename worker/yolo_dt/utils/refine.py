@@ -0,0 +1,65 @@
+# Coarse-to-fine ball detection: a high-resolution pass on a window around the ball's predicted position
+
+import torch
+
+
+class BallRefiner:
+    # The coarse pass (--img-size) covers the whole frame for the players. The ball boxes come from infer(crop, size)
+    # on a window x window crop centred on the position extrapolated from the last two ball detections. When the
+    # window finds nothing for lost_after frames in a row (or there is no track yet) the whole frame is searched
+    # at full_size instead. infer(im, size) returns the (k, 6) ball detections in im pixel coordinates
+    def __init__(self, infer, ball_cls=1, window=480, img_size=640, full_size=1280, lost_after=3):
+        self.infer = infer
+        self.ball_cls = ball_cls
+        self.window = window
+        self.img_size = img_size
+        self.full_size = full_size
+        self.lost_after = lost_after
+        self.track = []  # [(frame, cx, cy)] of the last ball detections, newest last
+        self.lost = lost_after  # frames since the ball was last seen
+        self.windows = self.full = 0  # passes run, for the summary
+
+    def predict(self, n):
+        if not self.track or self.lost >= self.lost_after:
+            return None
+        f1, x1, y1 = self.track[-1]
+        if len(self.track) < 2:
+            return x1, y1
+        f0, x0, y0 = self.track[-2]
+        k = (n - f1) / max(f1 - f0, 1)  # constant velocity
+        return x1 + k * (x1 - x0), y1 + k * (y1 - y0)
+
+    def __call__(self, n, det, im0):
+        # det: (k, 6) coarse detections of frame n in im0 coordinates -> same with the ball boxes replaced
+        h, w = im0.shape[:2]
+        p = self.predict(n)
+        if p is None:  # lost: high-resolution search of the whole frame
+            balls = self.infer(im0, self.full_size)
+            self.full += 1
+        else:
+            s = min(self.window, w, h)
+            x0 = int(min(max(p[0] - s / 2, 0), w - s))
+            y0 = int(min(max(p[1] - s / 2, 0), h - s))
+            balls = self.infer(im0[y0:y0 + s, x0:x0 + s], self.img_size)  # view, letterboxed by infer
+            balls[:, [0, 2]] += x0
+            balls[:, [1, 3]] += y0
+            self.windows += 1
+        balls = balls.to(det.device)
+
+        if len(balls):
+            i = 0 if p is None else int(torch.cdist(_centers(balls), torch.tensor([p], device=balls.device)).argmin())
+            c = _centers(balls[i:i + 1])[0]
+            self.track = (self.track + [(n, float(c[0]), float(c[1]))])[-2:]
+            self.lost = 0
+        else:
+            self.lost += 1
+            balls = det[det[:, 5] == self.ball_cls]  # keep what the coarse pass saw
+        out = torch.cat((det[det[:, 5] != self.ball_cls], balls), 0)
+        return out[out[:, 4].argsort(descending=True, stable=True)]  # NMS order
+
+    def summary(self):
+        return f'ball refine: {self.windows} window passes, {self.full} full-frame searches'
+
+
+def _centers(b):
+    return torch.stack(((b[:, 0] + b[:, 2]) / 2, (b[:, 1] + b[:, 3]) / 2), 1)
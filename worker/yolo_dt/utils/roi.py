@@ -0,0 +1,49 @@
+# Pitch ROI: per-camera profile with the pitch polygon, inference on its bounding crop, off-pitch boxes dropped
+
+import json
+
+import numpy as np
+import shapely
+from shapely.geometry import Polygon
+
+
+class PitchROI:
+    # Profile json: {"width": 1920, "height": 1080, "pitch": [[x, y], ...], "margin": 24, "keep_outside": ["ball"]}
+    # pitch is in pixels of a width x height frame and is rescaled to the video resolution; margin (pixels) grows
+    # both the crop and the polygon; classes in keep_outside are never dropped (e.g. a ball in the air)
+    def __init__(self, pitch, frame_shape, margin=0, keep_outside=(), names=()):
+        h, w = frame_shape[:2]
+        self.frame_shape = (h, w)
+        self.polygon = Polygon(pitch).buffer(margin) if margin else Polygon(pitch)
+        shapely.prepare(self.polygon)
+        x1, y1, x2, y2 = self.polygon.bounds
+        self.crop = (max(int(x1), 0), max(int(y1), 0), min(int(np.ceil(x2)), w), min(int(np.ceil(y2)), h))
+        self.offset = self.crop[:2] * 2  # added to (x1, y1, x2, y2)
+        self.shape = (self.crop[3] - self.crop[1], self.crop[2] - self.crop[0])  # (h, w) of the crop
+        self.keep_outside = [names.index(n) for n in keep_outside if n in names]
+
+    @classmethod
+    def load(cls, path, frame_shape, names=()):
+        with open(path, 'r', encoding='utf-8') as f:
+            p = json.load(f)
+        h, w = frame_shape[:2]
+        sx, sy = w / p.get('width', w), h / p.get('height', h)
+        pitch = [(x * sx, y * sy) for x, y in p['pitch']]
+        return cls(pitch, frame_shape, margin=p.get('margin', 0) * sx, keep_outside=p.get('keep_outside', ()),
+                   names=list(names))
+
+    def keep(self, det):
+        # Bool mask over det rows (xyxy first): the box's bottom-center (feet) lies inside the pitch polygon
+        d = det[:, :6].cpu().numpy() if hasattr(det, 'cpu') else np.asarray(det)
+        inside = shapely.contains_xy(self.polygon, (d[:, 0] + d[:, 2]) / 2, d[:, 3])
+        if self.keep_outside:
+            inside |= np.isin(d[:, 5].astype(int), self.keep_outside)
+        return inside
+
+    def __repr__(self):
+        return f'PitchROI(crop={self.crop}, {100 * self.area_fraction:.0f}% of the frame)'
+
+    @property
+    def area_fraction(self):
+        return self.shape[0] * self.shape[1] / max(self.frame_shape[0] * self.frame_shape[1], 1)
+
@@ -0,0 +1,145 @@
+# Time-segment sharded detection: K detect.py processes over consecutive frame ranges, merged in frame order
+
+import os
+import shutil
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import cv2
+
+from utils.writers import JsonlWriter, iter_jsonl, jsonl_to_json
+from detarrays import Detections  # worker/detarrays.py
+from videoio import FFMPEG_BIN, open_video
+
+
+def shard_ranges(n_frames, shards):
+    # Split [0, n_frames) into `shards` consecutive [start, end) ranges; the last one is open-ended (end = -1)
+    # because container frame counts can be short
+    shards = max(1, min(shards, n_frames)) if n_frames > 0 else 1
+    bounds = [round(i * n_frames / shards) for i in range(shards)]
+    return [(s, bounds[i + 1] if i + 1 < shards else -1) for i, s in enumerate(bounds)]
+
+
+class Shard:
+    def __init__(self, i, start, end, save_dir):
+        self.i, self.start, self.end = i, start, end
+        self.dir = Path(save_dir) / 'shards' / str(i)
+        self.proc = None
+        self.attempts = 0
+        self.log = None
+
+    def launch(self, argv, threads):
+        # Later occurrences of an option win in argparse, so the shard overrides are appended to the parent argv
+        args = [*argv, '--shards', '1', '--frame-range', str(self.start), str(self.end), '--threads', str(threads),
+                '--ort-threads', str(threads), '--project', str(self.dir.parent), '--name', self.dir.name,
+                '--exist-ok', '--save-json']
+        env = dict(os.environ, OMP_NUM_THREADS=str(threads), MKL_NUM_THREADS=str(threads))
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.log = open(self.dir / f'log{self.attempts}.txt', 'w')
+        self.proc = subprocess.Popen([sys.executable, str(Path(__file__).resolve().parents[1] / 'detect.py'), *args],
+                                     cwd=str(Path(__file__).resolve().parents[1]), env=env, stdout=self.log,
+                                     stderr=subprocess.STDOUT)
+        self.attempts += 1
+
+    def poll(self):
+        rc = self.proc.poll()
+        if rc is not None:
+            self.log.close()
+        return rc
+
+    def kill(self):
+        if self.proc and self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        if self.log:
+            self.log.close()
+
+    def output(self, pattern):
+        return next(iter(sorted(self.dir.glob(pattern))), None)
+
+    def frames_done(self):
+        f = self.output('*.jsonl')
+        if f is None:
+            return 0
+        with open(f, 'rb') as fp:
+            return sum(1 for _ in fp)
+
+
+def run_shards(opt, save_dir, progress=None, poll=0.5):
+    # Run opt.shards detect.py processes (opt.shard_threads torch threads each) over consecutive frame ranges,
+    # retrying a failed shard up to opt.shard_retries times, then merge the per-shard outputs into save_dir
+    # progress(frames, total) is called while the shards run and while their results are merged; an exception
+    # raised by it kills the shards / stops the merge
+    source = opt.source
+    cap = open_video(source, opt.decoder)
+    n_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    cores = opt.threads or (len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1)
+    threads = opt.shard_threads or max(1, cores // opt.shards)  # --threads: the budget of the whole run
+    shards = [Shard(i, s, e, save_dir) for i, (s, e) in enumerate(shard_ranges(n_frames, opt.shards))]
+    print(f'sharded detection: {len(shards)} shards x {threads} threads, ranges {[(s.start, s.end) for s in shards]}')
+
+    t0 = time.time()
+    pending, running = list(shards), []
+    try:
+        while pending or running:
+            while pending and len(running) < len(shards):
+                sh = pending.pop(0)
+                sh.launch(opt.argv, threads)
+                running.append(sh)
+            time.sleep(poll)
+            for sh in list(running):
+                rc = sh.poll()
+                if rc is None:
+                    continue
+                running.remove(sh)
+                if rc == 0:
+                    continue
+                if sh.attempts > opt.shard_retries:
+                    raise RuntimeError(f'shard {sh.i} frames [{sh.start}, {sh.end}) failed {sh.attempts}x, '
+                                       f'see {sh.dir}/log{sh.attempts - 1}.txt')
+                print(f'shard {sh.i} exited with {rc}, retrying ({sh.attempts}/{opt.shard_retries})')
+                shutil.rmtree(sh.dir, ignore_errors=True)
+                pending.append(sh)
+            if progress is not None:
+                progress(sum(sh.frames_done() for sh in shards), n_frames or None)
+    finally:
+        for sh in running:
+            sh.kill()
+    print(f'shards done in {time.time() - t0:.1f}s')
+    return merge_shards(opt, shards, save_dir, progress, n_frames or None)
+
+
+def merge_shards(opt, shards, save_dir, progress=None, total=None):
+    # Concatenate the shard results in frame order; every shard writes absolute frame numbers
+    p = Path(opt.source)
+    save_path = str(save_dir / p.name)
+    results = JsonlWriter(save_dir / (p.stem + '.jsonl'), buffer=opt.json_buffer)
+    for sh in shards:
+        for frame, result in iter_jsonl(sh.output('*.jsonl')):
+            results.write(frame, result)
+            if progress is not None:
+                progress(int(frame) + 1, total)
+    results.close()
+
+    out = {'dir': str(save_dir), 'video': None, 'json': None, 'npz': None}
+    if opt.save_json:
+        out['json'] = jsonl_to_json(results.path, save_path[:-3] + 'json')
+    if opt.save_npz:
+        names = Detections.load(shards[0].output('*.npz')).names  # model class order
+        out['npz'] = Detections.from_records(iter_jsonl(results.path), names=names).save(save_path[:-3] + 'npz')
+    if opt.save_txt:  # per-frame label files already carry absolute frame numbers
+        for sh in shards:
+            for f in (sh.dir / 'labels').glob('*.txt'):
+                shutil.move(str(f), str(save_dir / 'labels' / f.name))
+    videos = [sh.output(p.name) for sh in shards]
+    if not opt.nosave and all(videos):
+        lst = save_dir / 'shards' / 'concat.txt'
+        lst.write_text(''.join(f"file '{v.resolve()}'\n" for v in videos))
+        rc = subprocess.run([FFMPEG_BIN, '-hide_banner', '-loglevel', 'error', '-y', '-f', 'concat', '-safe', '0',
+                             '-i', str(lst), '-c', 'copy', save_path]).returncode
+        out['video'] = save_path if rc == 0 else None
+    shutil.rmtree(save_dir / 'shards', ignore_errors=True)
+    return out
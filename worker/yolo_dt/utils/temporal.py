@@ -0,0 +1,138 @@
+# Temporal utils: frame-stride detection with per-class interpolated boxes, motion-gated inference
+
+from collections import deque
+
+import cv2
+import torch
+
+from utils.general import box_iou
+
+
+def interpolate_boxes(a, b, t, iou_thres=0.1):
+    # Boxes between keyframe detections a(n,6) and b(m,6) of one class at fraction t in (0, 1); returns (k,6)
+    # Matched pairs are blended linearly, unmatched boxes are held from the nearer keyframe
+    if not len(a) or not len(b):
+        out = a if t < 0.5 else b
+        return out.clone()
+    iou = box_iou(a[:, :4], b[:, :4])
+    ia, ib = [], []
+    for _ in range(min(len(a), len(b))):  # greedy matching, highest IoU first
+        v, k = iou.view(-1).max(0)
+        if v < iou_thres:
+            break
+        i, j = divmod(int(k), len(b))
+        ia.append(i)
+        ib.append(j)
+        iou[i, :] = -1
+        iou[:, j] = -1
+    out = (1 - t) * a[ia] + t * b[ib]
+    out[:, :4] = out[:, :4].round()
+    out[:, 5] = a[ia, 5]
+    held = a if t < 0.5 else b
+    used = set(ia if t < 0.5 else ib)
+    rest = [k for k in range(len(held)) if k not in used]
+    return torch.cat((out, held[rest]), 0)
+
+
+class StrideInterpolator:
+    # Runs the detector on every stride-th frame; the frames in between are filled by interpolating each class'
+    # boxes between the neighbouring inferred frames. One forward pass detects every class, so the stride is global:
+    # a shorter stride for one class would run the model on those frames anyway. Frames come back in order, delayed
+    # by at most `stride` frames, as (det(n,7), payload) where det[:, 6] is 1 for interpolated boxes
+    def __init__(self, stride, nc, iou_thres=0.1):
+        self.stride = stride
+        self.classes = range(nc)
+        self.iou_thres = iou_thres
+        self.pending = deque()  # [n, payload, {cls: (k,7)}]
+        self.last = {}  # cls -> (n, (k,6)) of the last keyframe
+
+    def due(self, n):
+        return n % self.stride == 0
+
+    def _fill(self, c, n, boxes):
+        prev = self.last.get(c)
+        for entry in self.pending:
+            m, _, parts = entry
+            if m >= n or c in parts:
+                continue
+            if prev is None:  # no earlier keyframe (e.g. shard start): hold the next one
+                parts[c] = _flag(boxes.clone(), 1)
+            else:
+                t = (m - prev[0]) / (n - prev[0])
+                parts[c] = _flag(interpolate_boxes(prev[1], boxes, t, self.iou_thres), 1)
+        self.last[c] = (n, boxes)
+
+    def _ready(self):
+        out = []
+        while self.pending and len(self.pending[0][2]) == len(self.classes):
+            n, payload, parts = self.pending.popleft()
+            det = torch.cat([parts[c] for c in sorted(parts)], 0)
+            out.append((det[det[:, 4].argsort(descending=True, stable=True)], payload))  # NMS order
+        return out
+
+    def push(self, n, det, payload):
+        # det: (k,6) CPU NMS output of frame n in im0 coordinates, or None when the frame was not due
+        parts = {}
+        self.pending.append([n, payload, parts])
+        if det is not None:  # inferred: a keyframe for every class
+            for c in self.classes:
+                boxes = det[det[:, 5] == c]
+                parts[c] = _flag(boxes, 0)
+                self._fill(c, n, boxes)
+        return self._ready()
+
+    def flush(self):
+        # End of stream: classes without a later keyframe hold their last boxes
+        for entry in self.pending:
+            for c in self.classes:
+                if c not in entry[2]:
+                    prev = self.last.get(c)
+                    entry[2][c] = _flag(prev[1].clone() if prev else torch.zeros((0, 6)), 1)
+        return self._ready()
+
+
+def _flag(det, v):
+    # Append an interpolated-flag column to a (k,6) detection tensor
+    return torch.cat((det, torch.full((len(det), 1), float(v), device=det.device)), 1)
+
+
+class MotionGate:
+    # Decides per frame whether the detector has to run: a downscaled, blurred grayscale copy of the frame is
+    # compared with the last frame that was inferred; when fewer than area_thres of its pixels changed by more than
+    # pixel_thres the previous detections are reused. After max_skip reused frames in a row a fresh pass is forced
+    def __init__(self, pixel_thres=12, area_thres=0.002, max_skip=30, width=160, region=None):
+        self.pixel_thres = pixel_thres
+        self.area_thres = area_thres
+        self.max_skip = max_skip
+        self.width = width
+        self.region = region  # (x1, y1, x2, y2), e.g. the pitch ROI: motion in the stands does not count
+        self.ref = None
+        self.run = 0  # reused frames since the last inference
+        self.checked = 0
+        self.skipped = 0
+
+    def _thumb(self, im0):
+        if self.region is not None:
+            x1, y1, x2, y2 = self.region
+            im0 = im0[y1:y2, x1:x2]
+        h, w = im0.shape[:2]
+        small = cv2.resize(im0, (self.width, max(round(self.width * h / w), 1)), interpolation=cv2.INTER_AREA)
+        return cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (3, 3), 0)
+
+    def check(self, im0):
+        # True: run the detector on this frame, False: reuse the previous frame's detections
+        thumb = self._thumb(im0)
+        self.checked += 1
+        if self.ref is not None and self.run < self.max_skip and thumb.shape == self.ref.shape:
+            changed = (cv2.absdiff(thumb, self.ref) > self.pixel_thres).mean()
+            if changed < self.area_thres:
+                self.run += 1
+                self.skipped += 1
+                return False
+        self.ref = thumb
+        self.run = 0
+        return True
+
+    def summary(self):
+        pct = 100 * self.skipped / max(self.checked, 1)
+        return f'motion gate: reused detections on {self.skipped}/{self.checked} frames ({pct:.1f}% skipped)'
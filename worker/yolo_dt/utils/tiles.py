@@ -0,0 +1,61 @@
+# Tiled inference: overlapping tile grid over the frame, tiles batched through the model, raw predictions mapped
+# back to frame coordinates so one NMS merges boxes across tiles
+
+import math
+
+import torch
+
+
+def parse_tiles(s):
+    # '2x3' -> (rows, cols)
+    r, c = str(s).lower().split('x')
+    return max(int(r), 1), max(int(c), 1)
+
+
+def tile_grid(h, w, rows, cols, overlap=0.0, region=None):
+    # (x1, y1, x2, y2) of rows x cols equal tiles covering region (default the whole h x w frame); neighbouring
+    # tiles share `overlap` of a tile so objects cut by one tile edge are whole in the next tile
+    x0, y0, x1, y1 = region or (0, 0, w, h)
+    W, H = x1 - x0, y1 - y0
+    tw = min(math.ceil(W / (cols - (cols - 1) * overlap)), W)
+    th = min(math.ceil(H / (rows - (rows - 1) * overlap)), H)
+    xs = [x0 + (round(i * (W - tw) / (cols - 1)) if cols > 1 else 0) for i in range(cols)]
+    ys = [y0 + (round(i * (H - th) / (rows - 1)) if rows > 1 else 0) for i in range(rows)]
+    return [(x, y, x + tw, y + th) for y in ys for x in xs]
+
+
+def tile_views(img0, grid):
+    # Zero-copy numpy views of img0, one per tile
+    return [img0[y1:y2, x1:x2] for x1, y1, x2, y2 in grid]
+
+
+def untile(pred, grid, img_shape, edge=2):
+    # pred (bs, T, n, 5 + nc) raw xywh predictions of T letterboxed tiles -> (bs, T * n, 5 + nc) in frame pixels
+    # Undoes letterbox() like scale_coords(): gain and padding from each tile's size and the model input shape.
+    # Boxes within `edge` pixels of a tile border inside the grid are objects cut by the tile. Their objectness is
+    # zeroed only when another tile holds the box clear of its own borders (the object fits in the overlap, that
+    # tile sees it whole); objects bigger than the overlap are cut in every tile, their partial boxes are kept and
+    # merged by the NMS that runs over all tiles
+    t = torch.tensor(grid, dtype=pred.dtype, device=pred.device)  # (T, 4)
+    tw, th = t[:, 2] - t[:, 0], t[:, 3] - t[:, 1]
+    gain = torch.minimum(img_shape[0] / th, img_shape[1] / tw)
+    padx, pady = (img_shape[1] - tw * gain) / 2, (img_shape[0] - th * gain) / 2
+    out = pred.clone()
+    out[..., 0] = (pred[..., 0] - padx[:, None]) / gain[:, None] + t[:, 0, None]
+    out[..., 1] = (pred[..., 1] - pady[:, None]) / gain[:, None] + t[:, 1, None]
+    out[..., 2:4] = pred[..., 2:4] / gain[:, None, None]
+
+    lo, hi = t[:, :2].min(0)[0], t[:, 2:].max(0)[0]  # grid bounds
+    inner = torch.cat((t[:, :2] > lo, t[:, 2:] < hi), 1)  # (T, 4) tile sides that are not the grid border
+    xy1 = out[..., :2] - out[..., 2:4] / 2
+    xy2 = out[..., :2] + out[..., 2:4] / 2
+    cut = ((torch.cat((xy1 - t[:, None, :2], t[:, None, 2:] - xy2), -1) < edge) & inner[:, None]).any(-1)  # (bs,T,n)
+    idx = cut.nonzero(as_tuple=True)
+    if len(idx[0]):
+        b1, b2 = xy1[idx], xy2[idx]  # (k, 2) cut boxes
+        margin = inner * edge  # (T, 4) no margin needed at the grid border
+        clear = ((b1[:, None] >= t[None, :, :2] + margin[None, :, :2]) &
+                 (b2[:, None] <= t[None, :, 2:] - margin[None, :, 2:])).all(-1)  # (k, T) box clear inside tile
+        clear[torch.arange(len(idx[1]), device=pred.device), idx[1]] = False  # not its own tile
+        out[..., 4][tuple(i[clear.any(1)] for i in idx)] = 0
+    return out.flatten(1, 2)
@@ -342,10 +342,12 @@ def revert_sync_batchnorm(module):
 
 class TracedModel(nn.Module):
 
-    def __init__(self, model=None, device=None, img_size=(640,640)): 
+    def __init__(self, model=None, device=None, img_size=(640,640), save_path=None, traced=None):
+        # save_path: where to write the traced module (nothing is written by default)
+        # traced: an already traced module (e.g. from the model cache), skips tracing
+        # img_size: int (square) or the (h, w) letterboxed input shape to trace with
         super(TracedModel, self).__init__()
         
-        print(" Convert model to Traced-model... ") 
         self.stride = model.stride
         self.names = model.names
         self.model = model
@@ -357,12 +359,17 @@ class TracedModel(nn.Module):
         self.detect_layer = self.model.model[-1]
         self.model.traced = True
         
-        rand_example = torch.rand(1, 3, img_size, img_size)
+        if traced is None:
+            print(" Convert model to Traced-model... ") 
+            rand_example = torch.rand(1, 3, *((img_size, img_size) if isinstance(img_size, int) else img_size))
         
-        traced_script_module = torch.jit.trace(self.model, rand_example, strict=False)
-        #traced_script_module = torch.jit.script(self.model)
-        traced_script_module.save("traced_model.pt")
-        print(" traced_script_module saved! ")
+            traced_script_module = torch.jit.trace(self.model, rand_example, strict=False)
+            #traced_script_module = torch.jit.script(self.model)
+            if save_path:
+                traced_script_module.save(str(save_path))
+                print(" traced_script_module saved! ")
+        else:
+            traced_script_module = traced
         self.model = traced_script_module
         self.model.to(device)
         self.detect_layer.to(device)
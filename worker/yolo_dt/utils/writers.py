@@ -0,0 +1,147 @@
+# Streaming result writers for detect.py: bounded buffers, incremental writes to disk
+
+import json
+import queue
+from collections import defaultdict
+from pathlib import Path
+from threading import Thread
+
+import cv2
+
+
+class JsonlWriter:
+    # Append one {"frame": n, "result": {class: [[[x1, y1], [x2, y2], conf], ...]}} line per frame
+    # At most `buffer` frames are held in memory; everything before the last flush survives a crash/cancel
+    def __init__(self, path, buffer=256):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.f = open(self.path, 'w', encoding='utf-8')
+        self.buffer = max(int(buffer), 1)
+        self.lines = []
+        self.n = 0  # frames written
+
+    def write(self, frame, result):
+        self.lines.append(json.dumps({'frame': str(frame), 'result': result}, separators=(',', ':')))
+        self.n += 1
+        if len(self.lines) >= self.buffer:
+            self.flush()
+
+    def flush(self):
+        if self.lines:
+            self.f.write('\n'.join(self.lines) + '\n')
+            self.lines = []
+        self.f.flush()
+
+    def close(self):
+        if not self.f.closed:
+            self.flush()
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def iter_jsonl(path):
+    # Yield (frame, result) from a JsonlWriter file, skipping a truncated last line
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                r = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            yield r['frame'], r['result']
+
+
+def jsonl_to_json(src, dst):
+    # Convert to the legacy {frame: {class: [...]}} detect.json layout, streaming (constant memory)
+    with open(dst, 'w', encoding='utf-8') as f:
+        f.write('{')
+        for i, (frame, result) in enumerate(iter_jsonl(src)):
+            f.write(('' if i == 0 else ', ') + json.dumps(frame) + ': ' + json.dumps(result))
+        f.write('}')
+    return dst
+
+
+class TextSink:
+    # Buffered appends to many small files (the --save-txt per-frame label files)
+    def __init__(self, max_lines=4096):
+        self.max_lines = max_lines
+        self.buf = defaultdict(list)
+        self.count = 0
+
+    def write(self, path, line):
+        self.buf[path].append(line)
+        self.count += 1
+        if self.count >= self.max_lines:
+            self.flush()
+
+    def flush(self):
+        for path, lines in self.buf.items():
+            with open(path, 'a') as f:
+                f.write('\n'.join(lines) + '\n')
+        self.buf.clear()
+        self.count = 0
+
+
+class VideoRenderer:
+    # Annotated video: boxes are drawn and the frame encoded on a background thread behind a queue of `depth`
+    # frames, so the inference loop only waits for the encoder when it is far behind. Every frame gets its boxes
+    # (drawing rectangles is cheap next to encoding) and a full queue blocks, frames are never dropped, so the
+    # video stays frame-aligned with the source and the detections; the waits are counted in summary(). scale < 1
+    # writes the whole video at a lower resolution (cheaper drawing + encoding). plot: utils.plots.plot_one_box
+    def __init__(self, path, fps, size, plot, names, colors, depth=16, scale=1.0):
+        self.scale = min(max(float(scale), 0.05), 1.0)
+        self.size = tuple(max(int(round(v * self.scale)) // 2 * 2, 2) for v in size)  # (w, h), even for the codec
+        self.writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*'mp4v'), fps, self.size)
+        self.plot, self.names, self.colors = plot, names, colors
+        self.queue = queue.Queue(maxsize=max(int(depth), 1))
+        self.rendered = self.blocked = 0
+        self.error = None
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def write(self, im0, boxes):
+        # im0 must not be modified by the caller afterwards; boxes: [(xyxy, conf, cls), ...] in im0 pixels
+        if self.error is not None:
+            raise self.error
+        try:
+            self.queue.put_nowait((im0, boxes))
+        except queue.Full:
+            self.blocked += 1
+            self.queue.put((im0, boxes))  # wait for the encoder rather than shorten the video
+        self.rendered += 1
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue  # keep draining so write() never blocks
+            im, boxes = item
+            try:
+                if im.shape[1::-1] != self.size:
+                    im = cv2.resize(im, self.size, interpolation=cv2.INTER_AREA)
+                sx, sy = self.size[0] / item[0].shape[1], self.size[1] / item[0].shape[0]
+                for xyxy, conf, c in boxes or ():
+                    self.plot([xyxy[0] * sx, xyxy[1] * sy, xyxy[2] * sx, xyxy[3] * sy], im,
+                                 label=f'{self.names[c]} {conf:.2f}', color=self.colors[c], line_thickness=2)
+                self.writer.write(im)
+            except Exception as e:  # re-raised by the next write()
+                self.error = e
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+            self.writer.release()
+        if self.error is not None:  # failed after the last write()
+            raise self.error
+
+    def summary(self):
+        return f'video: {self.rendered} frames rendered, waited for the encoder {self.blocked}x, ' \
+               f'{self.size[0]}x{self.size[1]}'